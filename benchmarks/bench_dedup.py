@@ -0,0 +1,99 @@
+"""
+Time building the near-duplicate index and querying it, and check how many near-duplicates it finds.
+Descriptions are random words, a share of the queries are lightly edited copies of indexed ones.
+
+    python benchmarks/bench_dedup.py --videos 1000000 --queries 10000
+"""
+import argparse
+import pathlib
+import random
+import statistics
+import tempfile
+import time
+
+from data_pipeline.constants import DEDUP_INDEX_FILE
+from data_pipeline.dedup import DedupIndex, MinHasher, text_shingles
+
+VOCABULARY_SIZE = 20_000
+
+
+def random_description(rng: random.Random, vocabulary: list[str]) -> str:
+    return ' '.join(rng.choices(vocabulary, k=rng.randint(30, 150)))
+
+
+def edit(rng: random.Random, description: str, vocabulary: list[str], edits: int) -> str:
+    """Replace a few words, like a re-upload with a new link or a different call to action"""
+    words = description.split()
+    for _ in range(edits):
+        words[rng.randrange(len(words))] = rng.choice(vocabulary)
+    return ' '.join(words)
+
+
+def percentile(samples: list[float], p: int) -> float:
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, len(samples) * p // 100)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--videos', type=int, default=1_000_000)
+    parser.add_argument('--queries', type=int, default=10_000)
+    parser.add_argument('--threshold', type=float, default=0.8)
+    parser.add_argument('--edits', type=int, default=1,
+                        help="Number of words changed in each near-duplicate query")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    vocabulary = [f"word{i}" for i in range(VOCABULARY_SIZE)]
+    hasher = MinHasher()
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        data_dir = pathlib.Path(data_dir)
+        with DedupIndex(data_dir, args.threshold) as index:
+            # Only the descriptions queried later are kept, a million of them don't need to stay in memory
+            kept = {}
+            signing = inserting = 0.0
+            start = time.perf_counter()
+            for i in range(args.videos):
+                description = random_description(rng, vocabulary)
+                if i < args.queries:
+                    kept[f"v{i}"] = description
+                t0 = time.perf_counter()
+                signature = hasher.signature(text_shingles(description))
+                t1 = time.perf_counter()
+                index.add('text', f"v{i}", signature)
+                index.record_result('topics', f"v{i}", "topic")
+                signing += t1 - t0
+                inserting += time.perf_counter() - t1
+                if (i + 1) % 100_000 == 0:
+                    print(f"  indexed {i + 1} videos in {time.perf_counter() - start:.0f}s")
+            build = time.perf_counter() - start
+            size = sum(path.stat().st_size for path in data_dir.glob(f"{DEDUP_INDEX_FILE}*"))
+            print(f"build: {args.videos} videos in {build:.1f}s ({args.videos / build:.0f} videos/s), "
+                  f"{signing / args.videos * 1e6:.0f}us signing and {inserting / args.videos * 1e6:.0f}us "
+                  f"inserting per video, {size / 1e6:.0f}MB on disk")
+
+            duplicate_times, unique_times = [], []
+            found = false_positives = 0
+            for i, (video_id, description) in enumerate(kept.items()):
+                duplicate = i % 2 == 0
+                text = edit(rng, description, vocabulary, args.edits) if duplicate \
+                    else random_description(rng, vocabulary)
+                start = time.perf_counter()
+                match = index.find_result('topics', 'text', hasher.signature(text_shingles(text)), f"q{i}")
+                (duplicate_times if duplicate else unique_times).append(time.perf_counter() - start)
+                if duplicate and match is not None and match.source_id == video_id:
+                    found += 1
+                elif not duplicate and match is not None:
+                    false_positives += 1
+
+            for name, times in (("near-duplicate", duplicate_times), ("unique", unique_times)):
+                print(f"query {name}: mean {statistics.mean(times) * 1e3:.2f}ms, "
+                      f"p50 {percentile(times, 50) * 1e3:.2f}ms, p99 {percentile(times, 99) * 1e3:.2f}ms")
+            print(f"found {found} of {len(duplicate_times)} near-duplicates with {args.edits} edited words, "
+                  f"{false_positives} false matches for {len(unique_times)} unique descriptions")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""
+Compare the shared .info.json loader against the json.load loop the commands used to run.
+
+    python benchmarks/bench_info_loader.py --videos 2000
+"""
+import argparse
+import json
+import pathlib
+import random
+import tempfile
+import time
+
+from data_pipeline.info_loader import JSON_PARSER, load_info_files, project_info
+
+
+def make_corpus(root: pathlib.Path, videos: int) -> list[str]:
+    random.seed(0)
+    paths = []
+    for i in range(videos):
+        channel_dir = root / f"UC{i % 20:022d}"
+        channel_dir.mkdir(exist_ok=True)
+        info = {
+            "id": f"{i:011d}",
+            "channel_id": channel_dir.name,
+            "channel": f"Channel {i % 20}",
+            "timestamp": 1600000000 + i,
+            "view_count": random.randint(0, 10 ** 6),
+            "like_count": random.randint(0, 10 ** 4),
+            "duration": random.randint(10, 7200),
+            "title": f"Video {i}",
+            "fulltitle": f"Video {i}",
+            "description": "word " * random.randint(20, 400),
+            # The bulk of a real info file is format and caption metadata nobody reads
+            "formats": [{"format_id": str(f), "url": "https://example.com/" + "x" * 400,
+                         "http_headers": {"User-Agent": "y" * 100}} for f in range(40)],
+            "thumbnails": [{"url": "https://example.com/" + "t" * 100, "id": str(t)} for t in range(40)],
+            "automatic_captions": {lang: [{"url": "https://example.com/" + "c" * 300, "ext": "vtt"}]
+                                   for lang in ("en", "ar", "fr", "de", "es", "ru", "zh", "ja")},
+        }
+        path = channel_dir / f"2020-01-01 - {info['id']}.info.json"
+        path.write_text(json.dumps(info))
+        paths.append(str(path))
+    return paths
+
+
+def per_command_loop(paths: list[str]) -> int:
+    count = 0
+    for path in paths:
+        with open(path, 'r') as f:
+            data = json.load(f)
+        project_info(data)
+        count += 1
+    return count
+
+
+def shared_loader(paths: list[str], workers: int | None) -> int:
+    return sum(1 for _ in load_info_files(paths, workers=workers))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--videos', type=int, default=2000)
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = make_corpus(pathlib.Path(tmp), args.videos)
+        size = sum(pathlib.Path(p).stat().st_size for p in paths) / 1024 / 1024
+        print(f"{len(paths)} files, {size:.1f} MiB, parser: {JSON_PARSER}")
+
+        start = time.perf_counter()
+        per_command_loop(paths)
+        baseline = time.perf_counter() - start
+        print(f"json.load loop:       {baseline:.3f}s ({len(paths) / baseline:.0f} files/s)")
+
+        start = time.perf_counter()
+        shared_loader(paths, 1)
+        serial = time.perf_counter() - start
+        print(f"loader, 1 worker:     {serial:.3f}s ({len(paths) / serial:.0f} files/s)")
+
+        start = time.perf_counter()
+        shared_loader(paths, args.workers)
+        parallel = time.perf_counter() - start
+        print(f"loader, pool:         {parallel:.3f}s ({len(paths) / parallel:.0f} files/s), "
+              f"{baseline / parallel:.1f}x faster")
+
+
+if __name__ == '__main__':
+    main()
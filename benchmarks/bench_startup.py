@@ -0,0 +1,84 @@
+"""
+Measure how long the CLI takes to start, and fail if it goes over budget or imports a heavy
+dependency before a command actually runs. Meant to be run in CI, since the CLI is invoked
+from cron and xargs thousands of times.
+
+    python benchmarks/bench_startup.py --budget-ms 150
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+INVOCATIONS = [
+    ["--help"],
+    ["extract-urls", "--help"],
+    ["generate-topics", "--help"],
+    ["run", "--help"],
+]
+
+# None of these should be imported just to parse arguments
+HEAVY_MODULES = {"boto3", "botocore", "yt_dlp", "langdetect", "torch", "whisper", "pyarrow", "numpy", "rich"}
+
+
+def import_times(invocation: list[str]) -> dict[str, int]:
+    """
+    Cumulative import time, in microseconds, of every module imported by the invocation.
+    Top level imports keep their name as is, nested ones are indented.
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-m", "data_pipeline", *invocation],
+                            capture_output=True, text=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        times[name[1:]] = int(cumulative)
+    return times
+
+
+def wall_time(invocation: list[str], runs: int) -> float:
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-m", "data_pipeline", *invocation],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples)
+
+
+def time_interpreter() -> float:
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", "pass"], check=True)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--budget-ms', type=float, default=150,
+                        help="Maximum median wall time of each invocation")
+    args = parser.parse_args()
+
+    interpreter = statistics.median(time_interpreter() for _ in range(args.runs))
+    print(f"{'bare interpreter':<24}{interpreter * 1000:.0f}ms")
+
+    failed = False
+    for invocation in INVOCATIONS:
+        times = import_times(invocation)
+        heavy = sorted({name.strip().split(".")[0] for name in times} & HEAVY_MODULES)
+        imports = sum(cumulative for name, cumulative in times.items() if not name.startswith(" "))
+        elapsed = wall_time(invocation, args.runs)
+        print(f"{' '.join(invocation):<24}{elapsed * 1000:.0f}ms wall, {imports / 1000:.1f}ms of imports")
+        if heavy:
+            print(f"    imports heavy modules: {', '.join(heavy)}")
+            failed = True
+        if elapsed * 1000 > args.budget_ms:
+            print(f"    over the {args.budget_ms:.0f}ms budget")
+            failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""
+Check the precompiled text helpers in data_pipeline.utils produce byte-identical output to
+the original per-call re.sub implementations, and time both.
+
+    python benchmarks/bench_utils.py --descriptions 20000
+"""
+import argparse
+import random
+import re
+import timeit
+
+from data_pipeline.utils import (
+    find_urls_in_text,
+    find_urls_many,
+    post_process_topic,
+    pre_process_description,
+    pre_process_many,
+)
+
+
+def legacy_pre_process_description(description: str) -> str:
+    try:
+        idx = description.index('Im Arabic')
+        if idx >= 0:
+            description = description[:idx]
+    except ValueError:
+        pass
+    subs = [
+        (r"Website: http[\w:/%.-]+", ""),
+        (r"Facebook: http[\w:/%.-]+", ""),
+        (r"Tiwtter: http[\w:/%.-]+", ""),
+        (r"Twitter: http[\w:/%.-]+", ""),
+        (r"Instagram: http[\w:/%.-]+", ""),
+        (r"Youtube: http[\w:/%.-]+", ""),
+        (r"-{2,}", ""),
+        (r"\s+", " "),
+        (r"\n", " "),
+    ]
+    for sub in subs:
+        description = re.sub(sub[0], sub[1], description)
+    return description.strip()
+
+
+def legacy_post_process_topic(topic: str) -> str:
+    subs = [
+        (r"-", ""),
+        (r"^\d+\.", ""),
+        (r"\*", ""),
+    ]
+    for sub in subs:
+        topic = re.sub(sub[0], sub[1], topic)
+    return topic.strip().lower()
+
+
+def legacy_find_urls_in_text(text: str) -> list[str]:
+    return re.findall(r"""(?:
+        (?:https?|ftp|file)://|www\.|ftp\.
+    )
+    (?:
+        \([-A-Z0-9+&@#/%=~_|$?!:,.]*\)|[-A-Z0-9+&@#/%=~_|$?!:,.]
+    )*
+    (?:
+        \([-A-Z0-9+&@#/%=~_|$?!:,.]*\)|[A-Z0-9+&@#/%=~_|$]
+    )""", text, flags=re.IGNORECASE | re.VERBOSE)
+
+
+WORDS = ("the news today ministry statement breaking live interview analysis war economy "
+         "الأخبار اليوم بيان عاجل مقابلة تحليل حصري Новости сегодня заявление").split()
+LINKS = ("Website: https://example.com/about", "Facebook: https://facebook.com/some.page-1",
+         "Twitter: https://twitter.com/handle", "Tiwtter: http://twitter.com/typo",
+         "Instagram: https://instagram.com/x_y", "Youtube: https://youtube.com/@channel",
+         "https://www.example.org/path?utm_source=yt&id=3", "(see www.site.com/page)",
+         "ftp://files.example.com/a.zip", "https://t.me/channel.")
+
+
+def make_description(rng: random.Random) -> str:
+    lines = []
+    for _ in range(rng.randint(1, 12)):
+        line = " ".join(rng.choice(WORDS) for _ in range(rng.randint(0, 25)))
+        if rng.random() < 0.3:
+            line += " " + rng.choice(LINKS)
+        if rng.random() < 0.2:
+            line = "-" * rng.randint(1, 30)
+        lines.append(line)
+    if rng.random() < 0.1:
+        lines.append("Im Arabic " + " ".join(rng.choice(WORDS) for _ in range(20)))
+    return ("\n" + rng.choice(["", " ", "\t", "\n"])).join(lines)
+
+
+def make_topic(rng: random.Random) -> str:
+    return rng.choice(["", "1. ", "2.", "- ", "* ", "**", "-1. "]) + rng.choice(
+        ["Politics", "Middle-East Conflict", "**Economy**", "Foreign-policy", "Sports 2024"])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--descriptions', type=int, default=20000)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    descriptions = [make_description(rng) for _ in range(args.descriptions)]
+    topics = [make_topic(rng) for _ in range(args.descriptions)]
+
+    for description in descriptions:
+        assert pre_process_description(description) == legacy_pre_process_description(description), description
+        assert find_urls_in_text(description) == legacy_find_urls_in_text(description), description
+    for topic in topics:
+        assert post_process_topic(topic) == legacy_post_process_topic(topic), topic
+    assert pre_process_many(descriptions) == [legacy_pre_process_description(d) for d in descriptions]
+    assert find_urls_many(descriptions) == [legacy_find_urls_in_text(d) for d in descriptions]
+    print(f"Output identical for {len(descriptions)} descriptions and {len(topics)} topics")
+
+    cases = [
+        ("pre_process_description",
+         lambda: [legacy_pre_process_description(d) for d in descriptions],
+         lambda: pre_process_many(descriptions)),
+        ("post_process_topic",
+         lambda: [legacy_post_process_topic(t) for t in topics],
+         lambda: [post_process_topic(t) for t in topics]),
+        ("find_urls_in_text",
+         lambda: [legacy_find_urls_in_text(d) for d in descriptions],
+         lambda: find_urls_many(descriptions)),
+    ]
+    for name, legacy, current in cases:
+        legacy_time = min(timeit.repeat(legacy, number=1, repeat=3))
+        current_time = min(timeit.repeat(current, number=1, repeat=3))
+        print(f"{name:25} legacy {legacy_time:.3f}s  current {current_time:.3f}s  "
+              f"{legacy_time / current_time:.1f}x faster")
+
+
+if __name__ == '__main__':
+    main()
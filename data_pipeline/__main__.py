@@ -1,24 +1,39 @@
 import argparse
+import importlib.util
 import logging
+import os
 import pathlib
+from typing import TYPE_CHECKING, Callable
 
-import rich.logging
+from . import commands
+from .constants import DEFAULT_DATA_DIR, MAX_PACK, PIPELINE_STAGES
+from .models import Args
 
-from .commands import download_channels, generate_topics, extract_urls, export_stats
+if TYPE_CHECKING:
+    from .sharding import Shard
 
-try:
-    from .commands.audio_transcriber import transcribe_audio
-    supports_transcription = True
-except ImportError:
-    transcribe_audio = None
-    supports_transcription = False
-from .constants import DEFAULT_DATA_DIR
-from .models import Args, DownloaderArgs, TopicGenerationArgs
+# Importing whisper loads torch, which takes seconds, so only check whether it's installed
+supports_transcription = importlib.util.find_spec('whisper') is not None
+
+# The function each subcommand runs. Command modules are only imported once one is dispatched,
+# so startup and --help don't pay for boto3, yt-dlp or langdetect.
+COMMANDS = {
+    'download': 'download_channels',
+    'generate-topics': 'generate_topics',
+    'transcribe-audio': 'transcribe_audio',
+    'extract-audio': 'extract_audio',
+    'extract-urls': 'extract_urls',
+    'export-video-stats': 'export_stats',
+    'merge': 'merge_shards',
+    'import-store': 'import_store',
+    'export-store': 'export_store',
+    'run': 'run_pipeline',
+}
 
 logger = logging.getLogger(__name__)
 
 
-def temperature(arg) -> float:
+def fraction(arg) -> float:
     try:
         f = float(arg)
     except ValueError:
@@ -28,48 +43,259 @@ def temperature(arg) -> float:
     return f
 
 
+def positive_int(arg) -> int:
+    try:
+        i = int(arg)
+    except ValueError:
+        raise argparse.ArgumentTypeError("Must be an integer.")
+    if i < 1:
+        raise argparse.ArgumentTypeError("Must be at least 1.")
+    return i
+
+
+def non_negative_int(arg) -> int:
+    try:
+        i = int(arg)
+    except ValueError:
+        raise argparse.ArgumentTypeError("Must be an integer.")
+    if i < 0:
+        raise argparse.ArgumentTypeError("Must not be negative.")
+    return i
+
+
+def _run(command: Callable[[Args], None], args: Args):
+    if args.metrics_file:
+        from .metrics import metrics
+        metrics.start(args.command)
+    profiler = None
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+    try:
+        if profiler:
+            profiler.runcall(command, args)
+        else:
+            command(args)
+    finally:
+        if profiler:
+            profiler.dump_stats(args.profile)
+            logger.info(f"Wrote profile to {args.profile}")
+        if args.metrics_file:
+            metrics.write(args.metrics_file)
+
+
+def shard(arg) -> 'Shard':
+    from .sharding import Shard
+    try:
+        index, count = (int(part) for part in arg.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError("Must be in the form i/N, e.g. 0/4.")
+    if count < 1 or index < 0 or index >= count:
+        raise argparse.ArgumentTypeError("i must be between 0 and N - 1.")
+    return Shard(index, count)
+
+
 def main():
     parser = argparse.ArgumentParser()
 
     base_parser = argparse.ArgumentParser(add_help=False)
     base_parser.add_argument('--data-dir', default=DEFAULT_DATA_DIR, type=pathlib.Path)
     base_parser.add_argument('--debug', action='store_true')
+    base_parser.add_argument('--metrics-file', type=pathlib.Path,
+                             help="Write per-stage timings, latency percentiles and counters to this file when "
+                                  "the command finishes. Prometheus textfile format if it ends in .prom, "
+                                  "JSON otherwise.")
+    base_parser.add_argument('--profile', type=pathlib.Path,
+                             help="Profile the command with cProfile and write the stats to this file, "
+                                  "e.g. for 'python -m pstats' or snakeviz. Only the main thread is profiled.")
 
     sp = parser.add_subparsers(dest='command')
 
-    dl_p = sp.add_parser('download', parents=[base_parser],
-                         help="Download audio and metadata from Youtube channels")
-    dl_p.add_argument('--cookies', type=pathlib.Path,
-                      help="A file containing browser cookies for your Youtube session in 'Netscape' format. "
-                           "Only necessary if Youtube throttles you unnecessarily. "
-                           "Browser extensions can help you download your cookies in this format.")
-    dl_p.add_argument('--wait', type=int, default=1,
-                      help="Time, in seconds, to wait between downloads. Transcripts are throttled heavily.")
-    dl_p.add_argument('channel_urls', nargs='+',
-                      help="A list of Youtube channel URLs to download content from")
-
-    tg_p = sp.add_parser('generate-topics', parents=[base_parser],
+    download_parser = argparse.ArgumentParser(add_help=False)
+    download_parser.add_argument('--cookies', type=pathlib.Path,
+                                 help="A file containing browser cookies for your Youtube session in 'Netscape' "
+                                      "format. Only necessary if Youtube throttles you unnecessarily. "
+                                      "Browser extensions can help you download your cookies in this format.")
+    download_parser.add_argument('--wait', type=int, default=1,
+                                 help="Time, in seconds, to wait between downloads. "
+                                      "Transcripts are throttled heavily.")
+    download_parser.add_argument('--limit-rate', type=str,
+                                 help="Maximum download rate per channel, in bytes per second (e.g. 50K or 4.2M)")
+    download_parser.add_argument('--parallel-channels', type=positive_int, default=1,
+                                 help="Number of channels to download at the same time. Each channel gets its own "
+                                      "downloader process, so one slow or throttled channel doesn't hold up "
+                                      "the rest.")
+    download_parser.add_argument('--stage', choices=['all', 'metadata', 'media'], default='all',
+                                 help="'metadata' only downloads video metadata and subtitles, 'media' only "
+                                      "downloads audio. Running the metadata stage first makes new videos "
+                                      "available to the other commands quickly, the media stage can follow later.")
+    download_parser.add_argument('--defer-audio-extraction', action='store_true',
+                                 help="Keep the audio in the container Youtube serves it in (opus/m4a) instead of "
+                                      "converting it to mp3 while downloading. Use extract-audio to convert it "
+                                      "later, or transcribe the native files directly.")
+    download_parser.add_argument('channel_urls', nargs='+',
+                                 help="A list of Youtube channel URLs to download content from")
+
+    topics_parser = argparse.ArgumentParser(add_help=False)
+    topics_parser.add_argument('--backend', choices=['bedrock', 'local', 'stub'], default='bedrock',
+                               help="Where topics are generated: Amazon Bedrock, a model run locally with "
+                                    "transformers (no network access needed), or a stub that picks the most "
+                                    "common words of each description, for testing")
+    topics_parser.add_argument('--local-model', type=str, default="Qwen/Qwen2.5-0.5B-Instruct",
+                               help="Hugging Face model the local backend runs. Any instruction-tuned model "
+                                    "with a chat template works.")
+    topics_parser.add_argument('--local-batch-size', type=positive_int, default=8,
+                               help="Number of videos the local backend generates topics for in each forward pass")
+    topics_parser.add_argument('--region', type=str,
+                               help="AWS region")
+    topics_parser.add_argument('--model-id', type=str, default="amazon.nova-lite-v1:0",
+                               help="Amazon bedrock Model ID. You must have 'requested' this model in your "
+                                    "AWS account.")
+    topics_parser.add_argument('--temperature', type=fraction, default=0.5,
+                               help="LLM temperature value to set on the model")
+    topics_parser.add_argument('--format', choices=['csv', 'parquet'], default='csv',
+                               help="Write a CSV file or a Parquet dataset partitioned by channel and year")
+    topics_parser.add_argument('--concurrency', type=positive_int, default=1,
+                               help="Number of videos to send to Bedrock at the same time. "
+                                    "Requests are automatically slowed down if Bedrock starts throttling.")
+    topics_parser.add_argument('--cache-size', type=non_negative_int, default=100_000,
+                               help="Maximum number of LLM responses to keep in the response cache. Videos whose "
+                                    "description was already sent with the same model and temperature reuse the "
+                                    "cached response. Set to 0 to disable the cache.")
+    topics_parser.add_argument('--pack', type=positive_int, default=1,
+                               help="Number of videos to send in each request. Packing several videos together "
+                                    "spends fewer tokens on the system prompt. Videos whose topics don't pass "
+                                    f"the guardrails are requested again individually. At most {MAX_PACK}, the "
+                                    f"reply to a larger pack wouldn't fit in the output token limit.")
+
+    transcription_parser = argparse.ArgumentParser(add_help=False)
+    transcription_parser.add_argument('--model', type=str, default="turbo",
+                                      help="Whisper model to use, e.g. tiny, base, small, medium, turbo")
+    transcription_parser.add_argument('--threads', type=positive_int,
+                                      help="Number of CPU threads each worker may use. Defaults to the number "
+                                           "of CPU cores divided by --workers.")
+    transcription_parser.add_argument('--streaming', action='store_true',
+                                      help="Decode audio in bounded windows and skip silent stretches instead of "
+                                           "loading the whole file into memory. Recommended for long videos and "
+                                           "live streams.")
+    transcription_parser.add_argument('--window', type=positive_int, default=300,
+                                      help="Length, in seconds, of each window of audio decoded in --streaming mode")
+    transcription_parser.add_argument('--audio-fingerprint', action='store_true',
+                                      help="With --dedup, reuse the transcript of a video whose audio is a "
+                                           "near-duplicate, compared using Chromaprint's fpcalc, which has to be "
+                                           "installed. Transcripts are never reused on descriptions alone.")
+    transcription_parser.add_argument('--store', action='store_true',
+                                      help="Write transcripts into the compressed segment store in data/store/ "
+                                           "instead of a .transcript.txt file next to each audio file")
+
+    dedup_parser = argparse.ArgumentParser(add_help=False)
+    dedup_parser.add_argument('--dedup', action='store_true',
+                              help="Reuse the result of a near-duplicate video (e.g. a re-upload or copy "
+                                   "with almost the same description) instead of processing it again. Each reuse "
+                                   "is recorded in data/dedup.sqlite.")
+    dedup_parser.add_argument('--dedup-threshold', type=fraction, default=0.8,
+                              help="Estimated similarity, between 0 and 1, from which two videos count as "
+                                   "near-duplicates")
+
+    shard_parser = argparse.ArgumentParser(add_help=False)
+    shard_group = shard_parser.add_mutually_exclusive_group()
+    shard_group.add_argument('--shard', type=shard,
+                             help="Only process shard i of N (e.g. 2/8), picked by a stable hash of the video ID. "
+                                  "Each shard writes its own output in data/shards/, combine them with merge.")
+    shard_group.add_argument('--claim-shards', type=positive_int, metavar='N',
+                             help="Split the videos into N shards and work through every shard no other process "
+                                  "has claimed. Any number of processes or hosts sharing the data directory can "
+                                  "run at once without processing a video twice.")
+    shard_parser.add_argument('--lease', type=positive_int, default=600,
+                              help="Time, in seconds, after which the claim of a process that stopped "
+                                   "renewing it (e.g. because its host crashed) can be taken over")
+
+    sp.add_parser('download', parents=[base_parser, download_parser],
+                  help="Download audio and metadata from Youtube channels")
+
+    tg_p = sp.add_parser('generate-topics', parents=[base_parser, topics_parser, dedup_parser, shard_parser],
                          help="Generate topics from already downloaded Youtube channel metadata")
-    tg_p.add_argument('--region', type=str,
-                      help="AWS region")
-    tg_p.add_argument('--model-id', type=str, default="amazon.nova-lite-v1:0",
-                      help="Amazon bedrock Model ID. You must have 'requested' this model in your AWS account.")
-    tg_p.add_argument('--temperature', type=temperature, default=0.5,
-                      help="LLM temperature value to set on the model")
+    tg_p.add_argument('--batch', action='store_true',
+                      help="Use Bedrock batch inference instead of one request per video. Cheaper for large "
+                           "numbers of videos, but results can take hours. Requires --batch-s3-uri and "
+                           "--batch-role-arn.")
+    tg_p.add_argument('--batch-s3-uri', type=str,
+                      help="S3 location (s3://bucket/prefix/) batch job input and output is written to")
+    tg_p.add_argument('--batch-role-arn', type=str,
+                      help="IAM service role Bedrock assumes to read and write --batch-s3-uri")
+    tg_p.add_argument('--batch-poll-interval', type=positive_int, default=60,
+                      help="Time, in seconds, between checks on the status of a batch job")
+
+    ea_p = sp.add_parser('extract-audio', parents=[base_parser],
+                         help="Convert audio downloaded with --defer-audio-extraction to mp3")
+    ea_p.add_argument('--workers', type=positive_int, default=os.cpu_count() or 1,
+                      help="Number of ffmpeg processes to run at the same time")
+    ea_p.add_argument('--quality', type=positive_int, default=192,
+                      help="mp3 bitrate in kbps")
+    ea_p.add_argument('--delete-source', action='store_true',
+                      help="Delete the original audio file after it is converted")
 
-    sp.add_parser('extract-urls', parents=[base_parser],
-                  help="Extract unique URLs from Youtube video descriptions")
+    eu_p = sp.add_parser('extract-urls', parents=[base_parser],
+                         help="Extract unique URLs from Youtube video descriptions")
+    eu_p.add_argument('--workers', type=positive_int, default=os.cpu_count() or 1,
+                      help="Number of processes to scan descriptions with")
 
-    sp.add_parser('export-video-stats', parents=[base_parser],
-                  help="Export statistics on the collected videos")
+    es_p = sp.add_parser('export-video-stats', parents=[base_parser],
+                         help="Export statistics on the collected videos")
+    es_p.add_argument('--format', choices=['csv', 'parquet'], default='csv',
+                      help="Write a CSV file or a Parquet dataset partitioned by channel and year")
 
     if supports_transcription:
-        sp.add_parser('transcribe-audio', parents=[base_parser],
-                      help="Transcribe audio from already downloaded Youtube channel audio")
+        ta_p = sp.add_parser('transcribe-audio',
+                             parents=[base_parser, transcription_parser, dedup_parser, shard_parser],
+                             help="Transcribe audio from already downloaded Youtube channel audio")
+        ta_p.add_argument('--workers', type=positive_int, default=1,
+                          help="Number of processes to transcribe with. Each worker loads its own copy "
+                               "of the model and runs on the CPU when more than one is used.")
+
+    run_p = sp.add_parser('run', parents=[base_parser, download_parser, topics_parser, transcription_parser,
+                                          dedup_parser],
+                          help="Download channels and pass each new video through every other stage as it arrives")
+    run_p.add_argument('--queue-size', type=positive_int, default=100,
+                       help="Maximum number of videos waiting for each stage. Downloading pauses when a "
+                            "stage falls this far behind.")
+    run_p.add_argument('--skip', choices=PIPELINE_STAGES, action='append', default=[],
+                       help="Leave a stage out of the pipeline, can be given more than once")
+    run_p.set_defaults(batch=False, workers=1, shard=None, claim_shards=None)
+
+    mg_p = sp.add_parser('merge', parents=[base_parser],
+                         help="Combine the topics written by each shard into the main output")
+    mg_p.add_argument('--format', choices=['csv', 'parquet'], default='csv',
+                      help="Format the shards were written in")
+
+    store_parser = argparse.ArgumentParser(add_help=False)
+    store_parser.add_argument('--collection', dest='collections', choices=['info', 'transcripts'],
+                              action='append',
+                              help="Only this kind of file, can be given more than once. Defaults to both.")
+
+    is_p = sp.add_parser('import-store', parents=[base_parser, store_parser],
+                         help="Pack .info.json files and transcripts into compressed segment stores")
+    is_p.add_argument('--delete', action='store_true',
+                      help="Delete each file once it is in the store. The metadata index keeps videos whose "
+                           ".info.json file was moved into the store.")
+
+    es_store_p = sp.add_parser('export-store', parents=[base_parser, store_parser],
+                               help="Write the files in the segment stores back out as one file per video")
+    es_store_p.set_defaults(delete=False)
 
     # noinspection PyTypeChecker
     args: Args = parser.parse_args()
+    if args.command == 'generate-topics' and args.batch and not (args.batch_s3_uri and args.batch_role_arn):
+        parser.error("--batch requires --batch-s3-uri and --batch-role-arn")
+    if args.command == 'generate-topics' and args.batch and args.backend != 'bedrock':
+        parser.error("--batch can only be used with the bedrock backend")
+    if getattr(args, 'pack', 1) > MAX_PACK:
+        parser.error(f"--pack can be at most {MAX_PACK}, the reply to a larger pack would be cut off")
+    if args.command in ('import-store', 'export-store') and not args.collections:
+        args.collections = ['info', 'transcripts']
 
+    # rich is only needed once a command actually runs
+    import rich.logging
     logging.basicConfig(
         level=logging.INFO,
         format="%(message)s",
@@ -82,16 +308,9 @@ def main():
     if not args.data_dir.exists():
         args.data_dir.mkdir()
 
-    if args.command == 'download':
-        args: DownloaderArgs
-        download_channels(args)
-    elif args.command == 'generate-topics':
-        args: TopicGenerationArgs
-        generate_topics(args)
-    elif args.command == 'transcribe-audio':
-        args: Args
-        transcribe_audio(args)
-    elif args.command == 'extract-urls':
-        extract_urls(args)
-    elif args.command == 'export-video-stats':
-        export_stats(args)
+    if args.command in COMMANDS:
+        _run(getattr(commands, COMMANDS[args.command]), args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+import pathlib
+import subprocess
+from typing import Iterator
+
+import numpy as np
+
+# Whisper expects 16kHz mono audio
+SAMPLE_RATE = 16000
+FRAME_SECONDS = 0.03
+# Speech is padded on both sides so quiet word onsets and endings aren't clipped
+PAD_SECONDS = 0.3
+# Regions of speech shorter than this aren't worth a Whisper call
+MIN_SPEECH_SECONDS = 0.5
+
+
+def _speech_mask(samples: np.ndarray, threshold_db: float) -> np.ndarray:
+    """Energy based voice activity detection, one boolean per FRAME_SECONDS frame"""
+    frame = int(SAMPLE_RATE * FRAME_SECONDS)
+    count = len(samples) // frame
+    frames = samples[:count * frame].reshape(count, frame)
+    rms = np.sqrt(np.mean(frames ** 2, axis=1))
+    mask = 20 * np.log10(rms + 1e-10) > threshold_db
+    pad = int(PAD_SECONDS / FRAME_SECONDS)
+    if pad and mask.any():
+        mask = np.convolve(mask, np.ones(2 * pad + 1), mode='same') > 0
+    return mask
+
+
+class SpeechWindows:
+    """
+    Decodes an audio file with ffmpeg in windows of at most window_seconds and yields
+    only the parts that contain speech. Windows are cut at a silent frame where possible
+    so words aren't split between two Whisper calls. At most about two windows of audio
+    are held in memory regardless of the length of the file.
+    """
+
+    def __init__(self, path: pathlib.Path, window_seconds: int = 300, threshold_db: float = -45.0):
+        self.path = path
+        self.window_samples = window_seconds * SAMPLE_RATE
+        self.threshold_db = threshold_db
+        self.total_seconds = 0.0
+        self.speech_seconds = 0.0
+
+    def _decode(self) -> Iterator[np.ndarray]:
+        cmd = ["ffmpeg", "-nostdin", "-loglevel", "error", "-threads", "0", "-i", str(self.path),
+               "-f", "s16le", "-ac", "1", "-ar", str(SAMPLE_RATE), "-"]
+        with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL) as proc:
+            while raw := proc.stdout.read(self.window_samples * 2):
+                yield np.frombuffer(raw, np.int16).astype(np.float32) / 32768.0
+        if proc.returncode != 0:
+            raise RuntimeError(f"ffmpeg failed to decode {self.path} (exit code {proc.returncode})")
+
+    def _speech(self, samples: np.ndarray) -> np.ndarray | None:
+        frame = int(SAMPLE_RATE * FRAME_SECONDS)
+        mask = _speech_mask(samples, self.threshold_db)
+        speech = samples[:len(mask) * frame].reshape(len(mask), frame)[mask].ravel()
+        self.total_seconds += len(samples) / SAMPLE_RATE
+        if len(speech) < MIN_SPEECH_SECONDS * SAMPLE_RATE:
+            return None
+        self.speech_seconds += len(speech) / SAMPLE_RATE
+        return speech
+
+    def __iter__(self) -> Iterator[np.ndarray]:
+        frame = int(SAMPLE_RATE * FRAME_SECONDS)
+        buffer = np.empty(0, dtype=np.float32)
+        for samples in self._decode():
+            buffer = np.concatenate([buffer, samples])
+            # A cut can take as little as half a window, so keep cutting until less than a window is left
+            while len(buffer) >= self.window_samples:
+                # Cut at the last silent frame in the back half of the window, or at the window end if there is none
+                mask = _speech_mask(buffer[:self.window_samples], self.threshold_db)
+                silent = np.flatnonzero(~mask[len(mask) // 2:])
+                cut = (len(mask) // 2 + silent[-1] + 1) * frame if len(silent) else len(mask) * frame
+                window, buffer = buffer[:cut], buffer[cut:]
+                if (speech := self._speech(window)) is not None:
+                    yield speech
+        if len(buffer) and (speech := self._speech(buffer)) is not None:
+            yield speech
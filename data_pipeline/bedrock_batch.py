@@ -0,0 +1,179 @@
+import json
+import logging
+import os
+import pathlib
+import time
+from typing import Iterable, Iterator, List, Tuple
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+# Bedrock rejects batch jobs with fewer records than this
+MIN_BATCH_RECORDS = 100
+MAX_BATCH_RECORDS = 50_000
+
+RUNNING_STATUSES = {'Submitted', 'Validating', 'Scheduled', 'InProgress', 'Stopping'}
+COMPLETED_STATUSES = {'Completed', 'PartiallyCompleted'}
+# Bedrock expects record IDs of 11 alphanumeric characters, the records are numbered with that many digits
+RECORD_ID_DIGITS = 11
+# A submitted job's name, ARN, S3 locations and record IDs are kept in work_dir in <job name>.job.json
+# until its output is read
+JOB_SUFFIX = '.job.json'
+
+
+class BatchJobFailedException(Exception):
+    pass
+
+
+def _model_input(model_id: str, system_prompt: str, text: str, max_tokens: int,
+                 temperature: float, top_p: float) -> dict:
+    """Batch jobs take the model's native InvokeModel body rather than the Converse API request"""
+    if 'anthropic.' in model_id:
+        return {
+            "anthropic_version": "bedrock-2023-05-31",
+            "system": system_prompt,
+            "messages": [{"role": "user", "content": [{"type": "text", "text": text}]}],
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            "top_p": top_p,
+        }
+    return {
+        "schemaVersion": "messages-v1",
+        "system": [{"text": system_prompt}],
+        "messages": [{"role": "user", "content": [{"text": text}]}],
+        "inferenceConfig": {
+            "max_new_tokens": max_tokens,
+            "temperature": temperature,
+            "top_p": top_p,
+        },
+    }
+
+
+def _model_output_text(model_output: dict) -> str:
+    if 'output' in model_output:
+        return model_output['output']['message']['content'][0]['text']
+    return model_output['content'][0]['text']
+
+
+def _split_s3_uri(uri: str) -> Tuple[str, str]:
+    parts = urlsplit(uri)
+    return parts.netloc, parts.path.lstrip('/')
+
+
+class BedrockBatchJob:
+    """
+    Runs a list of prompts through a Bedrock batch inference job: writes the JSONL input,
+    uploads it to S3, submits the job, waits for it and streams back the responses.
+    Every job is recorded in work_dir until its output has been read, so a run interrupted
+    while waiting on a job can resume it instead of paying for a new one.
+    Clients are passed in so a local stub can stand in for Bedrock and S3.
+    """
+
+    def __init__(self, bedrock_client, s3_client, model_id: str, role_arn: str, s3_uri: str,
+                 work_dir: pathlib.Path, poll_interval: int = 60):
+        self.bedrock = bedrock_client
+        self.s3 = s3_client
+        self.model_id = model_id
+        self.role_arn = role_arn
+        self.s3_uri = s3_uri.rstrip('/') + '/'
+        self.work_dir = work_dir
+        self.poll_interval = poll_interval
+
+    def _write_input(self, job_name: str, records: Iterable[Tuple[str, str]], system_prompt: str,
+                     max_tokens: int, temperature: float, top_p: float) -> Tuple[str, List[str]]:
+        """Returns the S3 URI of the input and the caller's ID of each record, in the order they were numbered"""
+        self.work_dir.mkdir(parents=True, exist_ok=True)
+        input_file = self.work_dir / f"{job_name}.jsonl"
+        record_ids = []
+        with open(input_file, 'w') as f:
+            for record_id, text in records:
+                model_input = _model_input(self.model_id, system_prompt, text, max_tokens, temperature, top_p)
+                f.write(json.dumps({"recordId": f"{len(record_ids):0{RECORD_ID_DIGITS}d}",
+                                    "modelInput": model_input}) + '\n')
+                record_ids.append(record_id)
+        input_uri = f"{self.s3_uri}{job_name}/{input_file.name}"
+        bucket, key = _split_s3_uri(input_uri)
+        self.s3.upload_file(str(input_file), bucket, key)
+        return input_uri, record_ids
+
+    def _wait(self, job_arn: str) -> str:
+        while True:
+            job = self.bedrock.get_model_invocation_job(jobIdentifier=job_arn)
+            status = job['status']
+            if status in COMPLETED_STATUSES:
+                return status
+            if status not in RUNNING_STATUSES:
+                raise BatchJobFailedException(f"Batch job {job_arn} ended with status {status}: {job.get('message')}")
+            logger.info(f"Batch job {job_arn} is {status}, checking again in {self.poll_interval}s")
+            time.sleep(self.poll_interval)
+
+    def _job_file(self, job_name: str) -> pathlib.Path:
+        return self.work_dir / f"{job_name}{JOB_SUFFIX}"
+
+    def run(self, records: Iterable[Tuple[str, str]], system_prompt: str,
+            max_tokens: int, temperature: float, top_p: float) -> Iterator[Tuple[str, str | None]]:
+        """
+        Yield (record_id, response text) for each record, text is None if the record failed.
+        Raises BatchJobFailedException if the job as a whole failed, was stopped or expired.
+        """
+        job_name = f"topics-{time.strftime('%Y%m%d-%H%M%S')}"
+        input_uri, record_ids = self._write_input(job_name, records, system_prompt, max_tokens, temperature, top_p)
+        output_uri = f"{self.s3_uri}{job_name}/output/"
+        job = self.bedrock.create_model_invocation_job(
+            jobName=job_name,
+            roleArn=self.role_arn,
+            modelId=self.model_id,
+            inputDataConfig={"s3InputDataConfig": {"s3Uri": input_uri, "s3InputFormat": "JSONL"}},
+            outputDataConfig={"s3OutputDataConfig": {"s3Uri": output_uri}},
+        )
+        state = {"job_name": job_name, "job_arn": job['jobArn'], "input_uri": input_uri, "output_uri": output_uri,
+                 "record_ids": record_ids}
+        job_file = self._job_file(job_name)
+        tmp_file = job_file.with_name(job_file.name + '.tmp')
+        tmp_file.write_text(json.dumps(state))
+        os.replace(tmp_file, job_file)
+        logger.info(f"Submitted batch job {state['job_arn']}")
+        try:
+            yield from self._results(state)
+        except BatchJobFailedException:
+            # There's nothing left to resume
+            job_file.unlink()
+            raise
+        job_file.unlink()
+
+    def resume(self) -> Iterator[Tuple[str, str | None]]:
+        """Yield (record_id, response text) for each record of the jobs an interrupted run never read"""
+        for job_file in sorted(self.work_dir.glob(f"*{JOB_SUFFIX}")):
+            state = json.loads(job_file.read_text())
+            logger.info(f"Resuming batch job {state['job_arn']} submitted by an earlier run")
+            try:
+                yield from self._results(state)
+            except BatchJobFailedException as e:
+                logger.warning(f"{e}. Its records are requested again.")
+            job_file.unlink()
+
+    def _results(self, state: dict) -> Iterator[Tuple[str, str | None]]:
+        job_arn = state['job_arn']
+        status = self._wait(job_arn)
+        logger.info(f"Batch job {job_arn} {status.lower()}")
+
+        # Results are written to <output uri>/<job id>/<input file name>.out
+        job_id = job_arn.rsplit('/', 1)[-1]
+        input_name = state['input_uri'].rsplit('/', 1)[-1]
+        bucket, key = _split_s3_uri(f"{state['output_uri']}{job_id}/{input_name}.out")
+        body = self.s3.get_object(Bucket=bucket, Key=key)['Body']
+        record_ids = state['record_ids']
+        for line in body.iter_lines():
+            if not line:
+                continue
+            result = json.loads(line)
+            index = int(result['recordId'])
+            if not 0 <= index < len(record_ids):
+                logger.warning(f"Ignoring batch record {result['recordId']}, which wasn't in the input")
+                continue
+            record_id = record_ids[index]
+            if 'error' in result or 'modelOutput' not in result:
+                logger.warning(f"Batch record {record_id} failed: {result.get('error')}")
+                yield record_id, None
+                continue
+            yield record_id, _model_output_text(result['modelOutput'])
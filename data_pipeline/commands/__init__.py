@@ -1,6 +1,23 @@
-from .media_downloader import download_channels
-from .url_extractor import extract_urls
-from .topic_generator import generate_topics
-from .video_stats_exporter import export_stats
+import importlib
 
-__all__ = ['download_channels', 'extract_urls', 'export_stats', 'generate_topics']
+# Each command pulls in its own heavy dependencies, so modules are only imported on first use
+_MODULES = {
+    'download_channels': 'media_downloader',
+    'extract_audio': 'audio_extractor',
+    'extract_urls': 'url_extractor',
+    'export_stats': 'video_stats_exporter',
+    'export_store': 'store_transfer',
+    'generate_topics': 'topic_generator',
+    'import_store': 'store_transfer',
+    'merge_shards': 'shard_merger',
+    'run_pipeline': 'pipeline',
+    'transcribe_audio': 'audio_transcriber',
+}
+
+__all__ = list(_MODULES)
+
+
+def __getattr__(name: str):
+    if name not in _MODULES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return getattr(importlib.import_module(f'.{_MODULES[name]}', __name__), name)
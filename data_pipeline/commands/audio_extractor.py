@@ -0,0 +1,78 @@
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
+import logging
+import os
+import pathlib
+import shutil
+import subprocess
+import time
+from typing import Dict, Iterator
+
+from ..constants import NATIVE_AUDIO_EXTENSIONS, VIDEO_SUBDIR
+from ..metrics import metrics, progress
+from ..models import AudioExtractionArgs
+
+logger = logging.getLogger(__name__)
+
+
+def _iter_pending_files(args: AudioExtractionArgs) -> Iterator[pathlib.Path]:
+    for path in (args.data_dir / VIDEO_SUBDIR).glob("**/*"):
+        if path.suffix not in NATIVE_AUDIO_EXTENSIONS:
+            continue
+        mp3_file = path.with_suffix('.mp3')
+        if mp3_file.exists() and mp3_file.stat().st_mtime >= path.stat().st_mtime:
+            logger.debug(f"Skipping {path}, already converted")
+            continue
+        yield path
+
+
+def _convert(source: pathlib.Path, quality: int, delete_source: bool) -> float:
+    start = time.perf_counter()
+    mp3_file = source.with_suffix('.mp3')
+    # Convert into a temporary file so an interrupted conversion isn't mistaken for a finished one
+    tmp_file = source.with_suffix('.mp3.part')
+    cmd = ["ffmpeg", "-nostdin", "-loglevel", "error", "-y", "-threads", "1", "-i", str(source),
+           "-vn", "-codec:a", "libmp3lame", "-b:a", f"{quality}k", "-f", "mp3", str(tmp_file)]
+    result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    if result.returncode != 0:
+        tmp_file.unlink(missing_ok=True)
+        raise RuntimeError(result.stderr.strip())
+    os.replace(tmp_file, mp3_file)
+    if delete_source:
+        source.unlink()
+    return time.perf_counter() - start
+
+
+def extract_audio(args: AudioExtractionArgs) -> None:
+    if shutil.which('ffmpeg') is None:
+        logger.error("ffmpeg not found. Please install ffmpeg.")
+        return
+
+    converted = 0
+    failed = 0
+
+    def finish(path: pathlib.Path, future: Future):
+        nonlocal converted, failed
+        try:
+            elapsed = future.result()
+        except RuntimeError as e:
+            failed += 1
+            metrics.count('ffmpeg.failed')
+            logger.error(f"Failed to convert {path}: {e}")
+            return
+        converted += 1
+        metrics.observe('ffmpeg.convert', elapsed)
+        logger.info(f"Converted {path.name} in {elapsed:.1f}s")
+
+    # ffmpeg does the work in its own process, threads are only needed to keep a fixed number of them running
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        in_flight: Dict[Future, pathlib.Path] = {}
+        for path in progress(_iter_pending_files(args), "Converting", unit="file"):
+            in_flight[executor.submit(_convert, path, args.quality, args.delete_source)] = path
+            if len(in_flight) >= args.workers * 2:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    finish(in_flight.pop(future), future)
+        for future in as_completed(in_flight):
+            finish(in_flight[future], future)
+
+    logger.info(f"Converted {converted} files to mp3, {failed} failed")
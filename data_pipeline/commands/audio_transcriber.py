@@ -1,29 +1,381 @@
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, as_completed, wait
+import contextlib
+import io
 import json
 import logging
+import multiprocessing
+import os
 import pathlib
+import time
+from typing import TYPE_CHECKING, Callable, Container, Dict, Iterable, Iterator, List, Tuple
 
+from ..audio import SpeechWindows
 from ..constants import VIDEO_SUBDIR
-from ..models import Args
+from ..dedup import (
+    DedupIndex,
+    MinHasher,
+    audio_shingles,
+    supports_audio_fingerprint,
+    supports_dedup,
+)
+from ..language import detect_language
+from ..metadata_index import MetadataIndex, VideoMetadata, open_shard_index
+from ..metrics import metrics, progress
+from ..models import TranscriptionArgs
+from ..segment_store import SegmentStore, open_store, store_dir, supports_segment_store
+from ..sharding import Shard, in_shard, iter_shards, while_held
+from ..utils import find_audio_file, iter_audio_files
 
 import langdetect
+import torch
 import whisper
 
+if TYPE_CHECKING:
+    import numpy as np
+
 logger = logging.getLogger(__name__)
 
+# Near-duplicates only share a transcript if their lengths differ by at most this fraction
+MAX_DURATION_DIFFERENCE = 0.02
+# Written next to a transcript reused from a near-duplicate, naming the video it came from
+REUSED_SUFFIX = '.transcript.reused.json'
 
-def transcribe_audio(args: Args) -> None:
-    whisper_model = whisper.load_model("turbo")
+# Loaded once per process by _load_model, so each worker pays for it only on startup
+_whisper_model = None
 
-    for file_path in (args.data_dir / VIDEO_SUBDIR).glob("**/*.mp3"):
-        file_path: pathlib.Path
-        with open(file_path.with_suffix(".info.json"), 'r') as f:
-            info_json = json.load(f)
-        logger.info(f"Processing {file_path}")
-        language = langdetect.detect(info_json['description'])
-        logger.info(f"Detected language: {language}")
 
-        logger.info("Extracting transcript")
-        result = whisper.transcribe(whisper_model, str(file_path), language=language)
-        transcript_file = file_path.with_suffix('.transcript.txt')
-        with open(transcript_file, 'w') as f:
+def _load_model(model_name: str, threads: int | None, device: str | None = None):
+    global _whisper_model
+    if threads:
+        torch.set_num_threads(threads)
+    _whisper_model = whisper.load_model(model_name, device=device)
+
+
+def _transcribe_file(file_path: pathlib.Path, language: str | None,
+                     streaming: bool = False, window_seconds: int = 300,
+                     to_store: bool = False) -> Tuple[float, str | None]:
+    """
+    Write the transcript next to the audio file, or return it to be put in the segment store if to_store
+    is set. Only the main process writes into the store, so workers hand it back instead.
+    """
+    start = time.perf_counter()
+    transcript_file = file_path.with_suffix('.transcript.txt')
+    # Write to a temporary file first so an interrupted run never leaves a partial transcript behind
+    tmp_file = transcript_file.with_suffix('.tmp')
+    with (io.StringIO() if to_store else open(tmp_file, 'w')) as f:
+        if streaming:
+            speech_windows = SpeechWindows(file_path, window_seconds)
+            for audio in speech_windows:
+                result = whisper.transcribe(_whisper_model, audio, language=language)
+                for segment in result['segments']:
+                    f.write(segment['text'])
+                f.flush()
+            if speech_windows.total_seconds:
+                logger.info(f"Skipped {speech_windows.total_seconds - speech_windows.speech_seconds:.0f}s "
+                            f"of {speech_windows.total_seconds:.0f}s in {file_path.name} as silence")
+        else:
+            result = whisper.transcribe(_whisper_model, str(file_path), language=language)
             f.write(result['text'])
+        if to_store:
+            return time.perf_counter() - start, f.getvalue()
+    os.replace(tmp_file, transcript_file)
+    return time.perf_counter() - start, None
+
+
+def _is_transcribed(file_path: pathlib.Path) -> bool:
+    transcript_file = file_path.with_suffix('.transcript.txt')
+    try:
+        return transcript_file.stat().st_mtime >= file_path.stat().st_mtime
+    except FileNotFoundError:
+        return False
+
+
+def _video_language(file_path: pathlib.Path, video: VideoMetadata) -> str | None:
+    try:
+        language = detect_language(video.description or '')
+        logger.info(f"Detected language for {file_path.name}: {language}")
+        return language
+    except langdetect.LangDetectException:
+        # Let Whisper detect the language from the audio itself
+        return None
+
+
+def _list_audio_files(video_dir: pathlib.Path, index: MetadataIndex) -> List[Tuple[pathlib.Path, str]]:
+    """
+    Every downloaded audio file with the ID of its video. Listed once for all the shards of a run,
+    it's a full scan of the videos directory.
+    """
+    ids = index.ids_by_path()
+    audio_files = []
+    for file_path in iter_audio_files(video_dir):
+        video_id = ids.get(os.path.relpath(file_path.with_suffix(".info.json"), video_dir))
+        if video_id is None:
+            if not _is_transcribed(file_path):
+                logger.warning(f"Skipping {file_path} because it has no .info.json file")
+            continue
+        audio_files.append((file_path, video_id))
+    return audio_files
+
+
+def _iter_pending_files(stored: Container[str],
+                        videos: Iterable[VideoMetadata] | None = None,
+                        index: MetadataIndex | None = None,
+                        audio_files: Iterable[Tuple[pathlib.Path, str]] = (),
+                        shard: Shard | None = None,
+                        on_transcribed: Callable[[pathlib.Path, VideoMetadata], None] | None = None,
+                        ) -> Iterator[Tuple[pathlib.Path, VideoMetadata, str | None]]:
+    """
+    Audio files of the shard without a transcript, either next to them or in stored, along with their
+    video and language. Without videos, the videos of audio_files are looked up in index.
+    on_transcribed is called with each file of the shard that already has a transcript.
+    """
+    if videos is not None:
+        for video in in_shard(videos, shard):
+            file_path = find_audio_file(video.path)
+            if file_path is None:
+                logger.debug(f"Skipping {video.id}, it has no audio")
+                continue
+            if _is_transcribed(file_path) or video.id in stored:
+                logger.debug(f"Skipping {file_path}, already transcribed")
+                if on_transcribed is not None:
+                    on_transcribed(file_path, video)
+                continue
+            yield file_path, video, _video_language(file_path, video)
+        return
+
+    for file_path, video_id in audio_files:
+        if shard is not None and not shard.contains(video_id):
+            continue
+        if _is_transcribed(file_path) or video_id in stored:
+            logger.debug(f"Skipping {file_path}, already transcribed")
+            # Looking the video up costs a query per file, so only when someone wants it
+            if on_transcribed is not None and (video := index.get(video_id)):
+                on_transcribed(file_path, video)
+            continue
+        video = index.get(video_id)
+        yield file_path, video, _video_language(file_path, video)
+
+
+class _RealTimeFactor:
+    """Tracks how long transcription takes relative to the length of the audio"""
+
+    def __init__(self):
+        self.files = 0
+        self.failed = 0
+        self.audio_seconds = 0.0
+        self.elapsed_seconds = 0.0
+
+    def record(self, file_path: pathlib.Path, video: VideoMetadata, elapsed: float):
+        self.files += 1
+        self.elapsed_seconds += elapsed
+        metrics.observe('whisper.transcribe', elapsed)
+        if video.duration:
+            self.audio_seconds += video.duration
+            logger.info(f"Transcribed {file_path.name} in {elapsed:.1f}s, "
+                        f"real-time factor {elapsed / video.duration:.3f}")
+        else:
+            logger.info(f"Transcribed {file_path.name} in {elapsed:.1f}s")
+
+    def summarize(self):
+        if self.failed:
+            logger.warning(f"Failed to transcribe {self.failed} files, they're tried again on the next run")
+        if self.files == 0:
+            if not self.failed:
+                logger.info("No new audio to transcribe")
+            return
+        summary = f"Transcribed {self.files} files in {self.elapsed_seconds:.1f}s of worker time"
+        if self.audio_seconds:
+            summary += f", overall real-time factor {self.elapsed_seconds / self.audio_seconds:.3f}"
+        logger.info(summary)
+
+
+class _Transcripts:
+    """
+    Records each finished transcription, and puts the transcript into the segment store if there is one.
+    With --dedup and --audio-fingerprint, also gives videos whose audio is a near-duplicate of an already
+    transcribed one its transcript.
+    """
+
+    def __init__(self, args: TranscriptionArgs, store: SegmentStore | None, stored: SegmentStore | None,
+                 index: MetadataIndex | None):
+        self.video_dir = args.data_dir / VIDEO_SUBDIR
+        self.store = store
+        # Where transcripts already in the store are read from, the same as store unless that's None
+        self.stored = stored
+        self.rtf = _RealTimeFactor()
+        # Different episodes of a show can have near-identical descriptions and lengths, so only matching
+        # audio is enough to share a transcript
+        reuse = args.dedup and args.audio_fingerprint
+        self.dedup = DedupIndex(args.data_dir, args.dedup_threshold) if reuse else None
+        self.hasher = MinHasher() if reuse else None
+        # Only used to find the transcripts of near-duplicates, opened here if the run has no index of its own
+        self._own_index = reuse and index is None
+        self.index = MetadataIndex(args.data_dir) if self._own_index else index
+
+    def close(self):
+        if self.dedup is not None:
+            self.dedup.close()
+            if self._own_index:
+                self.index.close()
+            metrics.count('dedup.transcripts.reused', self.dedup.reused)
+            logger.info(f"{self.dedup.reused} videos reused the transcript of a near-duplicate")
+
+    def _save(self, file_path: pathlib.Path, video: VideoMetadata, transcript: str):
+        transcript_file = file_path.with_suffix('.transcript.txt')
+        if self.store is not None:
+            self.store.put(video.id, os.path.relpath(transcript_file, self.video_dir), transcript.encode('utf-8'))
+            return
+        tmp_file = transcript_file.with_suffix('.tmp')
+        tmp_file.write_text(transcript)
+        os.replace(tmp_file, transcript_file)
+
+    def _transcript_of(self, video_id: str) -> str | None:
+        if self.stored is not None and (data := self.stored.get(video_id)) is not None:
+            return data.decode('utf-8')
+        video = self.index.get(video_id)
+        if video is None:
+            return None
+        try:
+            return video.path.with_name(video.path.name.removesuffix('.info.json') + '.transcript.txt').read_text()
+        except FileNotFoundError:
+            return None
+
+    def _signature(self, file_path: pathlib.Path, video: VideoMetadata) -> 'np.ndarray | None':
+        """The video's audio signature, computed and added to the index unless it's already in it"""
+        signature = self.dedup.signature('audio', video.id)
+        if signature is None:
+            signature = self.hasher.signature(audio_shingles(file_path))
+            if signature is not None:
+                self.dedup.add('audio', video.id, signature, video.duration)
+        return signature
+
+    def transcribed(self, file_path: pathlib.Path, video: VideoMetadata):
+        """Make a video transcribed in an earlier run available for its near-duplicates to reuse"""
+        if not self.dedup.has_result('transcripts', video.id):
+            self._signature(file_path, video)
+            self.dedup.record_result('transcripts', video.id)
+
+    def reuse(self, file_path: pathlib.Path, video: VideoMetadata) -> bool:
+        """Give the video the transcript of a near-duplicate, returns False if it has to be transcribed"""
+        if self.dedup is None or (signature := self._signature(file_path, video)) is None:
+            return False
+        # Only the start of the audio is fingerprinted, which a clip shares with the full video,
+        # so lengths have to agree too
+        match = self.dedup.find_result('transcripts', 'audio', signature, video.id,
+                                       video.duration, MAX_DURATION_DIFFERENCE)
+        if match is None or (transcript := self._transcript_of(match.source_id)) is None:
+            return False
+        self._save(file_path, video, transcript)
+        # Reused transcripts would otherwise look just like transcribed ones
+        file_path.with_suffix(REUSED_SUFFIX).write_text(json.dumps(
+            {'reused_from': match.source_id, 'kind': 'audio', 'similarity': match.similarity}))
+        self.dedup.record_reuse('transcripts', video.id, 'audio', match)
+        self.dedup.record_result('transcripts', video.id)
+        return True
+
+    def record_future(self, file_path: pathlib.Path, video: VideoMetadata, future: Future):
+        try:
+            result = future.result()
+        except Exception:
+            # A corrupt file or a failed decode shouldn't throw away the work of the other workers
+            self.fail(file_path)
+            return
+        self.record(file_path, video, result)
+
+    def fail(self, file_path: pathlib.Path):
+        logger.exception(f"Failed to transcribe {file_path}")
+        metrics.count('transcripts.failed')
+        self.rtf.failed += 1
+
+    def record(self, file_path: pathlib.Path, video: VideoMetadata, result: Tuple[float, str | None]):
+        elapsed, transcript = result
+        if transcript is not None:
+            self._save(file_path, video, transcript)
+        if self.dedup is not None:
+            self.dedup.record_result('transcripts', video.id)
+        self.rtf.record(file_path, video, elapsed)
+
+    def finish_shard(self):
+        # Make the shard's transcripts visible before its lease is released
+        if self.store is not None:
+            self.store.flush()
+
+
+def transcribe_audio(args: TranscriptionArgs, videos: Iterable[VideoMetadata] | None = None) -> None:
+    """
+    Transcribe the audio of videos, or every downloaded audio file if videos isn't given.
+    Transcripts are written next to the audio, or into the transcripts segment store with --store.
+    Audio whose transcript is in the store is skipped either way.
+    """
+    has_store = store_dir(args.data_dir, 'transcripts').exists()
+    if (args.store or has_store) and not supports_segment_store:
+        logger.error("zstandard not found. Install it to use the transcripts segment store.")
+        return
+    if args.dedup and not supports_dedup:
+        logger.error("numpy not found. Install it to skip near-duplicate videos.")
+        return
+    if args.audio_fingerprint and not supports_audio_fingerprint:
+        logger.error("fpcalc not found. Install Chromaprint to fingerprint audio.")
+        return
+    if args.dedup and not args.audio_fingerprint:
+        logger.info("Transcripts are only reused between videos with matching audio, "
+                    "add --audio-fingerprint to reuse them")
+    with contextlib.ExitStack() as stack:
+        store = stack.enter_context(open_store(args.data_dir, 'transcripts')) if args.store else None
+        stored = store
+        if stored is None and has_store:
+            # Transcripts moved into the store, e.g. with import-store --delete, still count without --store
+            stored = stack.enter_context(open_store(args.data_dir, 'transcripts', read_only=True))
+        index = stack.enter_context(open_shard_index(args)) if videos is None else None
+        transcripts = _Transcripts(args, store, stored, index)
+        stack.callback(transcripts.close)
+        _transcribe_all(args, videos, index, stored if stored is not None else (), transcripts)
+    transcripts.rtf.summarize()
+
+
+def _transcribe_all(args: TranscriptionArgs, videos: Iterable[VideoMetadata] | None, index: MetadataIndex | None,
+                    stored: Container[str], transcripts: _Transcripts):
+    to_store = args.store
+    audio_files = _list_audio_files(args.data_dir / VIDEO_SUBDIR, index) if videos is None else ()
+    on_transcribed = transcripts.transcribed if transcripts.dedup is not None else None
+    if args.workers == 1:
+        _load_model(args.model, args.threads)
+        for shard, lease in iter_shards(args, 'transcripts'):
+            pending = while_held(_iter_pending_files(stored, videos, index, audio_files, shard, on_transcribed), lease)
+            for file_path, video, language in progress(pending, "Transcribing", unit="file"):
+                if transcripts.reuse(file_path, video):
+                    continue
+                logger.info(f"Processing {file_path}")
+                try:
+                    result = _transcribe_file(file_path, language, args.streaming, args.window, to_store)
+                except Exception:
+                    transcripts.fail(file_path)
+                    continue
+                transcripts.record(file_path, video, result)
+            transcripts.finish_shard()
+        return
+
+    # Torch uses every core by default, so the cores are split between the workers unless --threads is given
+    threads = args.threads or max(1, (os.cpu_count() or 1) // args.workers)
+    # Each worker loads its own copy of the model on CPU; spawn avoids forking a process that has torch loaded
+    with ProcessPoolExecutor(max_workers=args.workers,
+                             mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_load_model,
+                             initargs=(args.model, threads, 'cpu')) as executor:
+        for shard, lease in iter_shards(args, 'transcripts'):
+            in_flight: Dict[Future, Tuple[pathlib.Path, VideoMetadata]] = {}
+            pending = while_held(_iter_pending_files(stored, videos, index, audio_files, shard, on_transcribed), lease)
+            for file_path, video, language in progress(pending, "Transcribing", unit="file"):
+                if transcripts.reuse(file_path, video):
+                    continue
+                future = executor.submit(_transcribe_file, file_path, language, args.streaming, args.window,
+                                         to_store)
+                in_flight[future] = (file_path, video)
+                if len(in_flight) >= args.workers * 2:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        transcripts.record_future(*in_flight.pop(future), future)
+            # Finish the shard's files before moving on, which releases its lease
+            for future in as_completed(in_flight):
+                transcripts.record_future(*in_flight[future], future)
+            transcripts.finish_shard()
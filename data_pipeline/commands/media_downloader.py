@@ -1,51 +1,183 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import dataclasses
 import logging
-from typing import List
+import pathlib
 import shutil
+import time
+from typing import Callable
 
 import yt_dlp
+import yt_dlp.postprocessor
+import yt_dlp.utils
 
 from ..constants import VIDEO_SUBDIR
+from ..metrics import metrics
 from ..models import DownloaderArgs
 
 logger = logging.getLogger(__name__)
 
+METADATA_ARCHIVE_FILE = 'metadata_archive.txt'
+DOWNLOAD_ARCHIVE_FILE = 'download_archive.txt'
+
+
+@dataclasses.dataclass
+class ChannelStats:
+    channel_url: str
+    downloaded: int = 0
+    errors: int = 0
+    elapsed: float = 0.0
+    failure: str | None = None
+
+
+class _ChannelLogger:
+    """Routes yt-dlp output through our logger, prefixed with the channel, and counts errors"""
+
+    def __init__(self, stats: ChannelStats):
+        self.stats = stats
+        self.prefix = f"[{stats.channel_url}] "
+
+    def debug(self, msg: str):
+        # yt-dlp sends info messages to debug as well, prefixed with "[debug] " when they're real debug output
+        if msg.startswith('[debug] '):
+            logger.debug(self.prefix + msg)
+        else:
+            logger.info(self.prefix + msg)
+
+    def info(self, msg: str):
+        logger.info(self.prefix + msg)
+
+    def warning(self, msg: str):
+        logger.warning(self.prefix + msg)
+
+    def error(self, msg: str):
+        self.stats.errors += 1
+        logger.error(self.prefix + msg)
+
+
+# Called with the .info.json file of each video once it's downloaded
+ProgressCallback = Callable[[pathlib.Path], None]
 
-def download_channels(args: DownloaderArgs) -> None:
-    if shutil.which('ffmpeg') is None:
-        logger.error("ffmpeg not found. Please install ffmpeg.")
-        return
 
-    downloaded_video_infos: List[dict] = []
+class _VideoCounter(yt_dlp.postprocessor.PostProcessor):
+    """Runs once each video is completely processed, unlike progress hooks which don't fire for skipped downloads"""
 
-    def progress_callback(video_data):
-        if video_data['status'] == 'finished':
-            downloaded_video_infos.append(video_data.get('info_dict'))
+    def __init__(self, stats: ChannelStats, progress_callback: ProgressCallback | None = None):
+        super().__init__()
+        self.stats = stats
+        self.progress_callback = progress_callback
 
+    def run(self, info):
+        self.stats.downloaded += 1
+        if self.progress_callback is not None:
+            # The media stage doesn't write the .info.json itself, it's left from the metadata stage
+            info_file = info.get('infojson_filename')
+            if info_file is None and info.get('filepath'):
+                info_file = pathlib.Path(info['filepath']).with_suffix('.info.json')
+            if info_file is not None and pathlib.Path(info_file).exists():
+                self.progress_callback(pathlib.Path(info_file))
+        return [], info
+
+
+def _ydl_opts(args: DownloaderArgs, stats: ChannelStats) -> dict:
     ydl_opts = {
-        'writeinfojson': 'true',
-        'writesubtitles': 'true',
-        'writeautomaticsub': 'true',
         'sleep_interval': args.wait,
         'sleep_interval_subtitles': args.wait,
-        'download_archive': str(args.data_dir / 'download_archive.txt'),
-        'format': 'bestaudio/best',
-        'postprocessors': [{
-            'key': 'FFmpegExtractAudio',
-            'preferredcodec': 'mp3',
-            'preferredquality': '192',
-        }],
         'outtmpl': (f'{args.data_dir}/{VIDEO_SUBDIR}/%(channel_id)s/'
                     f'%(upload_date>%Y-%m-%d)s - %(id)s.%(ext)s'),
-        'progress_hooks': [progress_callback],
+        'logger': _ChannelLogger(stats),
+        # Progress bars from several channels would just interleave in the log
+        'noprogress': True,
+        # Keep going with the rest of the channel if a single video fails, it's counted in the stats
+        'ignoreerrors': 'only_download',
     }
+    if args.limit_rate:
+        ydl_opts['ratelimit'] = yt_dlp.utils.parse_bytes(args.limit_rate)
     if args.cookies:
-        if not args.cookies.exists():
-            logger.error("Cookies file does not exist")
-            return
         ydl_opts['cookiefile'] = str(args.cookies)
 
-    with yt_dlp.YoutubeDL(ydl_opts) as ytdl:
-        logger.info("Downloading videos")
-        ytdl.download(args.channel_urls)
+    if args.stage in ('all', 'metadata'):
+        ydl_opts.update({
+            'writeinfojson': 'true',
+            'writesubtitles': 'true',
+            'writeautomaticsub': 'true',
+        })
+    if args.stage == 'metadata':
+        # yt-dlp doesn't archive videos it skips downloading, so track the metadata stage separately
+        ydl_opts.update({
+            'skip_download': True,
+            'download_archive': str(args.data_dir / METADATA_ARCHIVE_FILE),
+            'force_write_download_archive': True,
+        })
+    else:
+        ydl_opts.update({
+            'download_archive': str(args.data_dir / DOWNLOAD_ARCHIVE_FILE),
+            'format': 'bestaudio/best',
+        })
+        if not args.defer_audio_extraction:
+            ydl_opts['postprocessors'] = [{
+                'key': 'FFmpegExtractAudio',
+                'preferredcodec': 'mp3',
+                'preferredquality': '192',
+            }]
+    return ydl_opts
+
+
+def _download_channel(args: DownloaderArgs, channel_url: str,
+                      progress_callback: ProgressCallback | None = None) -> ChannelStats:
+    """Download a single channel with its own yt-dlp instance, so its throttling doesn't stall other channels"""
+    stats = ChannelStats(channel_url)
+    start = time.monotonic()
+    try:
+        # The download archive is shared between workers, yt-dlp locks the file for each append
+        with yt_dlp.YoutubeDL(_ydl_opts(args, stats)) as ytdl:
+            ytdl.add_post_processor(_VideoCounter(stats, progress_callback), when='after_video')
+            ytdl.download([channel_url])
+    except yt_dlp.utils.DownloadError as e:
+        stats.failure = str(e)
+    stats.elapsed = time.monotonic() - start
+    return stats
+
+
+def _log_stats(stats: ChannelStats):
+    metrics.observe('download.channel', stats.elapsed)
+    metrics.count('download.videos', stats.downloaded)
+    metrics.count('download.errors', stats.errors)
+    if stats.failure:
+        logger.error(f"Channel {stats.channel_url} failed after {stats.elapsed:.0f}s "
+                     f"and {stats.downloaded} downloads: {stats.failure}")
+    else:
+        logger.info(f"Finished {stats.channel_url} in {stats.elapsed:.0f}s: "
+                    f"{stats.downloaded} downloaded, {stats.errors} errors")
+
+
+def download_channels(args: DownloaderArgs, progress_callback: ProgressCallback | None = None) -> None:
+    """
+    progress_callback is called with the .info.json file of every newly downloaded video. When channels
+    are downloaded in parallel it's called from the worker processes, so it must be picklable.
+    """
+    if args.stage != 'metadata' and not args.defer_audio_extraction and shutil.which('ffmpeg') is None:
+        logger.error("ffmpeg not found. Please install ffmpeg.")
+        return
+    if args.cookies and not args.cookies.exists():
+        logger.error("Cookies file does not exist")
+        return
+
+    logger.info("Downloading videos")
+    results = []
+    if args.parallel_channels == 1:
+        for channel_url in args.channel_urls:
+            results.append(_download_channel(args, channel_url, progress_callback))
+            _log_stats(results[-1])
+    else:
+        with ProcessPoolExecutor(max_workers=args.parallel_channels) as executor:
+            futures = [executor.submit(_download_channel, args, channel_url, progress_callback)
+                       for channel_url in args.channel_urls]
+            for future in as_completed(futures):
+                results.append(future.result())
+                _log_stats(results[-1])
 
-    logger.info("Downloaded %d videos", len(downloaded_video_infos))
+    failed = [stats.channel_url for stats in results if stats.failure]
+    logger.info("Downloaded %d videos from %d channels",
+                sum(stats.downloaded for stats in results), len(results) - len(failed))
+    if failed:
+        logger.error(f"{len(failed)} channels failed: {', '.join(failed)}")
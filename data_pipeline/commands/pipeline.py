@@ -0,0 +1,110 @@
+import importlib.util
+import logging
+import multiprocessing
+import pathlib
+import queue
+import threading
+from typing import Callable, Iterator, List
+
+from .. import commands
+from ..constants import PIPELINE_STAGES
+from ..metadata_index import MetadataIndex, VideoMetadata
+from ..models import PipelineArgs
+from .media_downloader import download_channels
+
+logger = logging.getLogger(__name__)
+
+# The command each stage runs, imported only when the stage isn't skipped
+STAGE_COMMANDS = {
+    'stats': 'export_stats',
+    'urls': 'extract_urls',
+    'topics': 'generate_topics',
+    'transcripts': 'transcribe_audio',
+}
+
+
+class _Stage(threading.Thread):
+    """
+    Runs one of the commands in a thread over the videos put in its queue. The queue is bounded,
+    so a stage that falls behind makes the dispatcher, and in turn the downloader, wait for it.
+    """
+
+    def __init__(self, name: str, command: Callable, args: PipelineArgs, queue_size: int):
+        super().__init__(name=f"{name}-stage", daemon=True)
+        self.stage_name = name
+        self.command = command
+        self.args = args
+        self.queue: queue.Queue[VideoMetadata | None] = queue.Queue(maxsize=queue_size)
+        self.processed = 0
+        self._finished = False
+
+    def _videos(self) -> Iterator[VideoMetadata]:
+        while (video := self.queue.get()) is not None:
+            self.processed += 1
+            yield video
+        self._finished = True
+
+    def run(self):
+        try:
+            self.command(self.args, videos=self._videos())
+        except Exception:
+            logger.exception(f"The {self.stage_name} stage failed, the remaining videos will skip it")
+        # Keep taking videos after a failure so the other stages don't stall behind this queue
+        while not self._finished:
+            self._finished = self.queue.get() is None
+
+
+def _dispatch(args: PipelineArgs, downloaded: queue.Queue, stages: List[_Stage]):
+    """Index each downloaded video and pass it on to every stage"""
+    index = None
+    finished = False
+    try:
+        index = MetadataIndex(args.data_dir)
+        while (info_file := downloaded.get()) is not None:
+            try:
+                video = index.add(pathlib.Path(info_file))
+            except Exception:
+                logger.exception(f"Could not index {info_file}, the stages will skip it")
+                continue
+            if video is None:
+                continue
+            for stage in stages:
+                stage.queue.put(video)
+        finished = True
+    except Exception:
+        logger.exception("The dispatcher failed, the remaining downloads won't be passed on to the stages")
+    finally:
+        if index is not None:
+            index.close()
+        for stage in stages:
+            stage.queue.put(None)
+    # Keep taking downloads after a failure so the downloader doesn't block on the full queue
+    while not finished:
+        finished = downloaded.get() is None
+
+
+def run_pipeline(args: PipelineArgs) -> None:
+    if 'transcripts' not in args.skip and importlib.util.find_spec('whisper') is None:
+        logger.warning("Whisper not found, videos won't be transcribed")
+        args.skip.append('transcripts')
+    stages = [_Stage(name, getattr(commands, STAGE_COMMANDS[name]), args, args.queue_size)
+              for name in PIPELINE_STAGES if name not in args.skip]
+    for stage in stages:
+        stage.start()
+
+    # Parallel channels download in separate processes, which need a queue they can share
+    manager = multiprocessing.Manager() if args.parallel_channels > 1 else None
+    downloaded = manager.Queue(maxsize=args.queue_size) if manager else queue.Queue(maxsize=args.queue_size)
+    dispatcher = threading.Thread(target=_dispatch, args=(args, downloaded, stages), name="dispatcher")
+    dispatcher.start()
+    try:
+        download_channels(args, progress_callback=downloaded.put)
+    finally:
+        downloaded.put(None)
+        dispatcher.join()
+        for stage in stages:
+            stage.join()
+        if manager:
+            manager.shutdown()
+    for stage in stages:
+        logger.info(f"The {stage.stage_name} stage processed {stage.processed} new videos")
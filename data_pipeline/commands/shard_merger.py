@@ -0,0 +1,38 @@
+import logging
+from typing import Set
+
+from ..models import MergeArgs
+from ..writers import TOPIC_COLUMNS, find_parts, iter_committed_rows, open_row_writer, supports_parquet
+
+logger = logging.getLogger(__name__)
+
+
+def merge_shards(args: MergeArgs) -> None:
+    """
+    Append the videos each shard has committed to the main topics output. Videos already merged are
+    skipped, so this can be run again while shards are still being processed to pick up their progress.
+    """
+    if args.format == 'parquet' and not supports_parquet:
+        logger.error("pyarrow not found. Install it to merge Parquet files.")
+        return
+    parts = find_parts(args.data_dir, 'topics', args.format)
+    if not parts:
+        logger.info("No shard outputs to merge")
+        return
+    with open_row_writer(args.data_dir, 'topics', TOPIC_COLUMNS, args.format) as writer:
+        logger.info(f"Merging {len(parts)} shard outputs into {writer.path}")
+        done = writer.completed_videos()
+        # Committed videos only reach the journal in groups, so also remember the ones merged in this run
+        merged: Set[str] = set()
+        for part in parts:
+            count = 0
+            for video_id, rows in iter_committed_rows(part, TOPIC_COLUMNS, args.format):
+                if video_id in merged or video_id in done:
+                    continue
+                for row in rows:
+                    writer.writerow(row)
+                writer.commit(video_id)
+                merged.add(video_id)
+                count += 1
+            logger.info(f"Merged {count} new videos from {part.name}")
+    logger.info(f"Merged {len(merged)} videos in total")
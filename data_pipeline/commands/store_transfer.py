@@ -0,0 +1,81 @@
+import logging
+import os
+import pathlib
+from typing import List
+
+from ..constants import VIDEO_SUBDIR
+from ..metadata_index import MetadataIndex, open_metadata_index
+from ..metrics import metrics, progress
+from ..models import StoreArgs
+from ..segment_store import COLLECTIONS, COMMIT_RECORDS, SegmentStore, open_store, store_dir, supports_segment_store
+
+logger = logging.getLogger(__name__)
+
+
+def _delete(files: List[pathlib.Path]):
+    for path in files:
+        path.unlink(missing_ok=True)
+    files.clear()
+
+
+def _import_collection(index: MetadataIndex, store: SegmentStore, collection: str, delete: bool):
+    suffix = COLLECTIONS[collection]
+    imported = 0
+    # Files are only deleted once the store has committed them
+    moved: List[pathlib.Path] = []
+    for video in progress(index.videos(), f"Importing {collection}", total=len(index)):
+        if video.id in store:
+            continue
+        path = video.path.with_name(video.path.name.removesuffix('.info.json') + suffix)
+        try:
+            data = path.read_bytes()
+        except FileNotFoundError:
+            continue
+        store.put(video.id, os.path.relpath(path, index.video_dir), data)
+        imported += 1
+        if delete:
+            moved.append(path)
+            if len(moved) >= COMMIT_RECORDS:
+                store.flush()
+                _delete(moved)
+    store.flush()
+    _delete(moved)
+    metrics.count(f'store.{collection}.imported', imported)
+    logger.info(f"Imported {imported} new {collection} files into {store.path}")
+
+
+def import_store(args: StoreArgs) -> None:
+    """Copy, or with --delete move, .info.json files and transcripts into their segment stores"""
+    if not supports_segment_store:
+        logger.error("zstandard not found. Install it to use the segment store.")
+        return
+    # The index is refreshed before any .info.json file is moved, and keeps the ones in the store after that
+    with open_metadata_index(args.data_dir) as index:
+        for collection in args.collections:
+            with open_store(args.data_dir, collection) as store:
+                _import_collection(index, store, collection, args.delete)
+
+
+def export_store(args: StoreArgs) -> None:
+    """Write every record of the segment stores back out to its file in the per-file layout"""
+    if not supports_segment_store:
+        logger.error("zstandard not found. Install it to use the segment store.")
+        return
+    video_dir = args.data_dir / VIDEO_SUBDIR
+    for collection in args.collections:
+        if not store_dir(args.data_dir, collection).exists():
+            logger.info(f"There is no {collection} store to export")
+            continue
+        exported = 0
+        with open_store(args.data_dir, collection) as store:
+            for _, path, data in progress(store.items(), f"Exporting {collection}", total=len(store), unit="file"):
+                target = video_dir / path
+                if target.exists():
+                    continue
+                target.parent.mkdir(parents=True, exist_ok=True)
+                tmp_file = target.with_name(target.name + '.tmp')
+                tmp_file.write_bytes(data)
+                os.replace(tmp_file, target)
+                exported += 1
+        metrics.count(f'store.{collection}.exported', exported)
+        logger.info(f"Exported {exported} {collection} files to {video_dir}")
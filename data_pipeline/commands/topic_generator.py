@@ -1,16 +1,21 @@
-import csv
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
+import contextlib
 from datetime import datetime
 import json
 import logging
-import pathlib
+import threading
 import time
-from typing import Set
+from typing import Callable, Container, Dict, Iterable, Iterator, List, Set, Tuple, TypeVar
 
 import boto3
 import botocore.exceptions
 
-from ..constants import VIDEO_SUBDIR
+from ..bedrock_batch import BatchJobFailedException, BedrockBatchJob, MAX_BATCH_RECORDS, MIN_BATCH_RECORDS
+from ..constants import BATCH_SUBDIR, LLM_CACHE_FILE, MAX_PACKED_TOKENS, MAX_TOKENS_PER_PACKED_VIDEO
+from ..dedup import DedupIndex, MinHasher, supports_dedup, text_shingles
 from ..guardrails import (
+    GuardrailChain,
     SufficientTextGuardrail,
     TranslatedGuardrail,
     PreambleGuardrail,
@@ -19,20 +24,18 @@ from ..guardrails import (
     InvalidLlmResponseException,
     NotTranslatedLlmResponseException,
 )
+from ..llm_backends import LlmBackend, create_backend, supports_local_llm
+from ..llm_cache import ResponseCache, response_cache_key
+from ..metadata_index import VideoMetadata, open_shard_index
+from ..metrics import metrics, progress
 from ..models import TopicGenerationArgs
+from ..sharding import in_shard, is_sharded, iter_shards, while_held
 from ..utils import pre_process_description, post_process_topic
+from ..writers import TOPIC_COLUMNS, open_row_writer, supports_parquet
 
 logger = logging.getLogger(__name__)
 
-
-def _get_existing_video_ids(csv_file: pathlib.Path) -> Set[str]:
-    seen = set()
-    with open(csv_file, 'r') as output_csv:
-        reader = csv.reader(output_csv)
-        next(reader, None)
-        for row in reader:
-            seen.add(row[0])
-    return seen
+T = TypeVar('T')
 
 
 PROMPT = """
@@ -45,129 +48,541 @@ SYSTEM_PROMPT = """You are an assistant that identifies the top three topics of
 Return those three topics in your response separated by line breaks. Do not include extra information before
 or after the topics. Do not number or mark the topics with bullets."""
 
+PACKED_SYSTEM_PROMPT = """You are an assistant that identifies the top three topics of each of several texts, translated into
+English. The user sends a JSON object mapping an id to each text. Reply with only a JSON object mapping each id to
+a list of its three topics, for example {"1": ["topic", "topic", "topic"]}. Keep the topic names short and do not
+number or mark the topics with bullets."""
 
-def generate_topics(args: TopicGenerationArgs):
-    input_guardrails = [
-        SufficientTextGuardrail()
+MAX_TOKENS = 512
+TOP_P = 0.9
+
+THROTTLING_ERROR_CODES = {'ThrottlingException', 'TooManyRequestsException', 'ServiceUnavailableException'}
+MAX_THROTTLE_RETRIES = 8
+
+
+class AdaptiveRateLimiter:
+    """
+    Spaces out Bedrock calls across all worker threads. The gap between calls doubles
+    every time Bedrock throttles us and shrinks again gradually as calls succeed.
+    """
+
+    def __init__(self, min_delay: float = 0.0, max_delay: float = 30.0):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self._delay = min_delay
+        self._next_slot = 0.0
+        self._last_throttle = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def delay(self) -> float:
+        return self._delay
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self._delay
+        if slot > now:
+            time.sleep(slot - now)
+
+    def on_throttle(self):
+        with self._lock:
+            now = time.monotonic()
+            # Several in-flight requests usually get throttled by the same burst, only back off once for it
+            if now - self._last_throttle >= self._delay:
+                self._delay = min(self.max_delay, max(self._delay * 2, 0.05))
+                logger.debug(f"Throttled by Bedrock, waiting {self._delay:.2f}s between requests")
+            self._last_throttle = now
+            self._next_slot = max(self._next_slot, now + self._delay)
+
+    def on_success(self):
+        with self._lock:
+            self._delay *= 0.8
+            if self._delay < 0.01:
+                self._delay = self.min_delay
+
+
+def _is_throttling_error(e: botocore.exceptions.ClientError) -> bool:
+    return e.response.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES
+
+
+class _TokenUsage:
+    """Counts tokens by kind of request, so packed and individual requests can be compared"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests: Dict[str, int] = defaultdict(int)
+        self.tokens: Dict[str, int] = defaultdict(int)
+        self.videos: Dict[str, int] = defaultdict(int)
+
+    def record_response(self, kind: str, response: dict):
+        usage = response.get('usage', {})
+        with self._lock:
+            self.requests[kind] += 1
+            self.tokens[kind] += usage.get('inputTokens', 0) + usage.get('outputTokens', 0)
+        metrics.count('llm.input_tokens', usage.get('inputTokens', 0))
+        metrics.count('llm.output_tokens', usage.get('outputTokens', 0))
+
+    def record_videos(self, kind: str, count: int):
+        with self._lock:
+            self.videos[kind] += count
+
+    def summarize(self):
+        for kind, videos in self.videos.items():
+            if videos:
+                logger.info(f"{kind.capitalize()} requests: {self.requests[kind]} requests for {videos} videos, "
+                            f"{self.tokens[kind] / videos:.0f} tokens per video")
+
+
+def _converse(backend: LlmBackend, rate_limiter: AdaptiveRateLimiter, usage: _TokenUsage, kind: str,
+              **request) -> dict:
+    """Call converse on the backend, waiting and trying again for as long as Bedrock throttles us"""
+    throttle_retries = MAX_THROTTLE_RETRIES
+    while True:
+        with metrics.timer('llm.rate_limit_wait'):
+            rate_limiter.wait()
+        try:
+            with metrics.timer(f'llm.converse.{kind}'):
+                response = backend.converse(**request)
+        except botocore.exceptions.ClientError as e:
+            if _is_throttling_error(e) and throttle_retries > 0:
+                # Throttling says nothing about the input, so it isn't counted against the caller's retries
+                metrics.count('llm.throttled')
+                rate_limiter.on_throttle()
+                throttle_retries -= 1
+                continue
+            raise
+        rate_limiter.on_success()
+        usage.record_response(kind, response)
+        return response
+
+
+def _iter_pending_videos(videos: Iterable[VideoMetadata],
+                         seen: Container[str],
+                         input_guardrails: GuardrailChain) -> Iterator[Tuple[VideoMetadata, str]]:
+    """Yield each video that still needs topics along with its pre-processed description"""
+    for idx, video in enumerate(videos):
+        if (idx + 1) % 100 == 0:
+            logger.info(f"Processing {idx}")
+        if video.id in seen:
+            logger.info(f"skipping {video.id}, already processed")
+            metrics.count('topics.already_processed')
+            continue
+        if video.timestamp is None:
+            logger.info(f"Skipping {video.id} because it has no timestamp")
+            continue
+        desc = video.title + '\n' + video.description
+        if not desc:
+            logger.info(f"Skipping {video.id} because it has no description")
+        try:
+            input_guardrails.evaluate(desc)
+        except InvalidLlmInputException as e:
+            logger.error(f"Skipping {video.id} because it has an invalid LLM input: {e}")
+            continue
+
+        with metrics.timer('topics.preprocess'):
+            desc = pre_process_description(desc)
+        yield video, desc
+
+
+def _request_topics(backend: LlmBackend,
+                    args: TopicGenerationArgs,
+                    desc: str,
+                    output_guardrails: GuardrailChain,
+                    rate_limiter: AdaptiveRateLimiter,
+                    usage: _TokenUsage) -> str | None:
+    conversation = [
+        {
+            "role": "user",
+            "content": [{"text": desc}],
+        }
     ]
-    output_guardrails = [
+    content: str | None = None
+    response = None
+    tries = 2
+    while response is None and tries > 0:
+        try:
+            response = _converse(
+                backend, rate_limiter, usage, 'individual',
+                modelId=backend.model_id,
+                messages=conversation,
+                system=[{"text": SYSTEM_PROMPT}],
+                inferenceConfig={
+                    "maxTokens": MAX_TOKENS,
+                    "temperature": args.temperature,
+                    "topP": TOP_P
+                },
+            )
+            pending_content: str = response['output']['message']['content'][0]['text']
+            logger.debug(f"Response before processing guardrails: {pending_content}")
+            output_guardrails.evaluate(pending_content)
+            content = pending_content
+        except botocore.exceptions.ClientError as e:
+            response = None
+            metrics.count('llm.retries')
+            logger.info(f"caught exception {e.__class__.__name__}, retrying...")
+            time.sleep(1)
+            tries -= 1
+        except NotTranslatedLlmResponseException:
+            response = None
+            metrics.count('llm.retries')
+            logger.warning("Received a non-English response. Attempting to redirect...")
+            # Continue the conversation and add a request to LLM to fix the previous response
+            conversation.extend([
+                {
+                    "role": "assistant",
+                    "content": [{"text": pending_content}],
+                },
+                {
+                    "role": "user",
+                    "content": [{"text": "The previous response was not translated into English. "
+                                         "Please only give English topics."}],
+                }
+            ])
+            tries -= 1
+        except InvalidLlmResponseException as e:
+            response = None
+            metrics.count('llm.retries')
+            logger.error(f"Received an invalid LLM response: {e}, retrying...")
+            tries -= 1
+    return content
+
+
+def _parse_packed_response(text: str) -> dict:
+    # Models like to wrap JSON in a markdown code block, only look at what's between the outer braces
+    start, end = text.find('{'), text.rfind('}')
+    if start < 0 or end < start:
+        raise InvalidLlmResponseException("Response does not contain a JSON object")
+    try:
+        parsed = json.loads(text[start:end + 1])
+    except json.JSONDecodeError as e:
+        raise InvalidLlmResponseException(f"Response is not valid JSON: {e}")
+    if not isinstance(parsed, dict):
+        raise InvalidLlmResponseException("Response is not a JSON object")
+    return parsed
+
+
+def _request_packed_topics(backend: LlmBackend,
+                           args: TopicGenerationArgs,
+                           requests: List[Tuple[str, str]],
+                           output_guardrails: GuardrailChain,
+                           rate_limiter: AdaptiveRateLimiter,
+                           usage: _TokenUsage) -> List[Tuple[str, str | None]]:
+    """
+    Ask for the topics of several descriptions in one request. Each video's topics are checked
+    against the output guardrails separately and videos that fail are requested individually.
+    """
+    # Short ids keep the prompt small, they only need to be stable within this request
+    texts = {str(i + 1): desc for i, (_, desc) in enumerate(requests)}
+    contents: Dict[str, str] = {}
+    try:
+        response = _converse(
+            backend, rate_limiter, usage, 'packed',
+            modelId=backend.model_id,
+            messages=[{"role": "user", "content": [{"text": json.dumps(texts, ensure_ascii=False)}]}],
+            system=[{"text": PACKED_SYSTEM_PROMPT}],
+            inferenceConfig={
+                "maxTokens": min(MAX_PACKED_TOKENS, MAX_TOKENS_PER_PACKED_VIDEO * len(requests)),
+                "temperature": args.temperature,
+                "topP": TOP_P
+            },
+        )
+        parsed = _parse_packed_response(response['output']['message']['content'][0]['text'])
+        for text_id, topics in parsed.items():
+            if text_id not in texts or not isinstance(topics, list):
+                continue
+            content = '\n'.join(str(topic) for topic in topics)
+            try:
+                output_guardrails.evaluate(content)
+            except InvalidLlmResponseException as e:
+                logger.debug(f"Packed topics for text {text_id} rejected: {e}")
+                continue
+            contents[text_id] = content
+    except botocore.exceptions.ClientError as e:
+        logger.info(f"caught exception {e.__class__.__name__} for a packed request, requesting individually...")
+    except InvalidLlmResponseException as e:
+        logger.error(f"Received an invalid packed LLM response: {e}, requesting individually...")
+    usage.record_videos('packed', len(contents))
+
+    results = []
+    for text_id, (key, desc) in zip(texts, requests):
+        if text_id in contents:
+            results.append((key, contents[text_id]))
+        else:
+            usage.record_videos('individual', 1)
+            results.append((key, _request_topics(backend, args, desc, output_guardrails, rate_limiter, usage)))
+    return results
+
+
+def _write_topics(writer, video: VideoMetadata, content: str | None, reused_from: str | None = None):
+    if content is None:
+        logger.error(f"Failed to get output for video {video.id} after retries, skipping.")
+        metrics.count('topics.failed')
+        return
+
+    topics = [line.strip() for line in content.splitlines() if len(line.strip()) > 0]
+    ts = datetime.fromtimestamp(video.timestamp)
+    for topic in topics:
+        processed_topic = post_process_topic(topic)
+        channel_name = video.channel or '<missing>'
+        view_count = video.view_count if video.view_count is not None else -1
+        like_count = video.like_count if video.like_count is not None else -1
+        duration = video.duration if video.duration is not None else -1
+        writer.writerow([
+            video.id, video.channel_id, channel_name,
+            ts.year, ts.month, ts.day, video.timestamp,
+            view_count, like_count, duration,
+            processed_topic, reused_from])
+    writer.commit(video.id)
+    metrics.count('topics.videos')
+
+
+class _PendingVideos:
+    """
+    Videos waiting on a response, by cache key, so identical descriptions share a single request.
+    With a dedup index, videos whose description is a near-duplicate of one that already has
+    topics reuse them. Only used from the thread that writes the CSV.
+    """
+
+    def __init__(self, writer, cache: ResponseCache | None, dedup: DedupIndex | None = None):
+        self.writer = writer
+        self.cache = cache
+        self.dedup = dedup
+        self.hasher = MinHasher() if dedup is not None else None
+        self.waiting: Dict[str, List[VideoMetadata]] = {}
+        self.shared = 0
+
+    def add(self, key: str, video: VideoMetadata, desc: str) -> bool:
+        """Returns True if a new request has to be made for the video"""
+        signature = self.hasher.signature(text_shingles(desc)) if self.hasher is not None else None
+        if signature is not None:
+            self.dedup.add('text', video.id, signature, video.duration)
+        if key in self.waiting:
+            self.waiting[key].append(video)
+            self.shared += 1
+            return False
+        if self.cache is not None and (content := self.cache.get(key)) is not None:
+            self._write(video, content)
+            return False
+        if signature is not None:
+            match = self.dedup.find_result('topics', 'text', signature, video.id)
+            if match is not None:
+                self.dedup.record_reuse('topics', video.id, 'text', match)
+                self._write(video, match.content, match.source_id)
+                return False
+        self.waiting[key] = [video]
+        return True
+
+    def _write(self, video: VideoMetadata, content: str | None, reused_from: str | None = None):
+        _write_topics(self.writer, video, content, reused_from)
+        if content is not None and self.dedup is not None:
+            self.dedup.record_result('topics', video.id, content)
+
+    def finish(self, key: str, content: str | None):
+        if content is not None and self.cache is not None:
+            self.cache.put(key, content)
+        for video in self.waiting.pop(key):
+            self._write(video, content)
+
+
+def _chunked(requests: Iterable[Tuple[str, str]], size: int) -> Iterator[List[Tuple[str, str]]]:
+    chunk = []
+    for request in requests:
+        chunk.append(request)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _request_sync(executor: ThreadPoolExecutor,
+                  concurrency: int,
+                  jobs: Iterable[T],
+                  request: Callable[[T], List[Tuple[str, str | None]]],
+                  pending: _PendingVideos):
+    # Workers only talk to Bedrock; every row is written from this thread so the CSV
+    # never interleaves and each video's topics land together, keeping resumes consistent.
+    in_flight: Set[Future] = set()
+    for job in jobs:
+        in_flight.add(executor.submit(request, job))
+        if len(in_flight) >= concurrency * 2:
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                for key, content in future.result():
+                    pending.finish(key, content)
+    for future in as_completed(in_flight):
+        for key, content in future.result():
+            pending.finish(key, content)
+
+
+def _finish_batch_record(key: str, content: str | None, output_guardrails: GuardrailChain,
+                         pending: _PendingVideos) -> bool:
+    """Returns False if the record has to be requested again"""
+    try:
+        if content is None:
+            raise InvalidLlmResponseException("batch record failed")
+        output_guardrails.evaluate(content)
+    except InvalidLlmResponseException as e:
+        logger.debug(f"Re-queueing batch record {key}: {e}")
+        return False
+    pending.finish(key, content)
+    return True
+
+
+def _run_batch_job(job: BedrockBatchJob,
+                   temperature: float,
+                   batch: Dict[str, str],
+                   output_guardrails: GuardrailChain,
+                   pending: _PendingVideos) -> Iterator[Tuple[str, str]]:
+    if len(batch) < MIN_BATCH_RECORDS:
+        logger.info(f"Only {len(batch)} videos left, below the batch job minimum of {MIN_BATCH_RECORDS}. "
+                    f"Sending them individually instead.")
+        yield from batch.items()
+        return
+
+    rejected = 0
+    try:
+        for key, content in job.run(batch.items(), SYSTEM_PROMPT, MAX_TOKENS, temperature, TOP_P):
+            desc = batch.pop(key, None)
+            if desc is None:
+                continue
+            if not _finish_batch_record(key, content, output_guardrails, pending):
+                rejected += 1
+                yield key, desc
+    except BatchJobFailedException as e:
+        logger.warning(f"{e}. Its records are requested again.")
+    if rejected or batch:
+        logger.info(f"Sending {rejected} rejected and {len(batch)} missing batch records individually")
+    # Records missing from the job output get another chance individually as well
+    yield from batch.items()
+
+
+def _request_batch(job: BedrockBatchJob,
+                   temperature: float,
+                   requests: Iterable[Tuple[str, str]],
+                   output_guardrails: GuardrailChain,
+                   pending: _PendingVideos) -> Iterator[Tuple[str, str]]:
+    """Send requests through Bedrock batch jobs, yielding the ones that need to be retried individually"""
+    # Jobs submitted by an interrupted run are waited for and read first, rather than paid for again
+    recovered = dict(job.resume())
+    if recovered:
+        logger.info(f"Recovered {len(recovered)} records from earlier batch jobs")
+    batch: Dict[str, str] = {}
+    for key, desc in requests:
+        if key in recovered and _finish_batch_record(key, recovered.pop(key), output_guardrails, pending):
+            continue
+        batch[key] = desc
+        if len(batch) >= MAX_BATCH_RECORDS:
+            yield from _run_batch_job(job, temperature, batch, output_guardrails, pending)
+            batch = {}
+    yield from _run_batch_job(job, temperature, batch, output_guardrails, pending)
+
+
+def _open_cache(args: TopicGenerationArgs) -> ResponseCache | None:
+    if not args.cache_size:
+        return None
+    path = args.data_dir / LLM_CACHE_FILE
+    if not is_sharded(args):
+        return ResponseCache(path, args.cache_size)
+    # Hosts sharing the data directory would all be writing to the one cache file, so sharded runs only read it
+    if not path.exists():
+        return None
+    return ResponseCache(path, args.cache_size, read_only=True)
+
+
+def generate_topics(args: TopicGenerationArgs, client_factory: Callable = boto3.client,
+                    videos: Iterable[VideoMetadata] | None = None):
+    """
+    Generate topics for videos, or for every video in the metadata index if videos isn't given.
+    client_factory creates the boto3 clients used to talk to Bedrock and S3,
+    and can be replaced with a stub for testing.
+    """
+    if args.format == 'parquet' and not supports_parquet:
+        logger.error("pyarrow not found. Install it to write Parquet files.")
+        return
+    if args.backend == 'local' and not supports_local_llm:
+        logger.error("transformers not found. Install it and torch to use the local backend.")
+        return
+    if args.dedup and not supports_dedup:
+        logger.error("numpy not found. Install it to skip near-duplicate videos.")
+        return
+    input_guardrails = GuardrailChain([
+        SufficientTextGuardrail()
+    ])
+    output_guardrails = GuardrailChain([
         TranslatedGuardrail(),
         PreambleGuardrail(),
         OutputFormatCheckerGuardrail(3),
-    ]
+    ])
 
     client_args = {}
     if args.region is not None:
         client_args['region_name'] = args.region
-    client = boto3.client("bedrock-runtime", **client_args)
-    csv_file = args.data_dir / 'topics.csv'
-    csv_file_exists = csv_file.exists()
-    if csv_file_exists:
-        seen = _get_existing_video_ids(csv_file)
-    else:
-        seen = set()
-    with open(csv_file, 'a') as output_csv:
-        writer = csv.writer(output_csv)
-        if not csv_file_exists:
-            writer.writerow([
-                "id", "channel_id", "channel_name",
-                "year", "month", "day", "timestamp",
-                "view_count", "like_count", "duration",
-                "topic"
-            ])
-        for idx, file in enumerate(pathlib.Path(args.data_dir / VIDEO_SUBDIR).glob("**/*.info.json")):
-            if (idx + 1) % 100 == 0:
-                logger.info(f"Processing {idx}")
-            with open(file, "r") as f:
-                data = json.load(f)
-                if data['id'] in seen:
-                    logger.info(f"skipping {data['id']}, already processed")
-                    continue
-                if 'timestamp' not in data:
-                    logger.info(f"Skipping {data['id']} because it has no timestamp")
-                    continue
-                desc = data.get('fulltitle', data.get('title')) + '\n' + data.get("description")
-                if not desc:
-                    logger.info(f"Skipping {data['id']} because it has no description")
-                passed_guardrails = True
-                for guardrail in input_guardrails:
-                    try:
-                        guardrail.evaluate(desc)
-                    except InvalidLlmInputException as e:
-                        logger.error(f"Skipping {data['id']} because it has an invalid LLM input: {e}")
-                        passed_guardrails = False
-                        break
-                if not passed_guardrails:
-                    continue
-
-                desc = pre_process_description(desc)
-                conversation = [
-                    {
-                        "role": "user",
-                        "content": [{"text": desc}],
-                    }
-                ]
-                content: str | None = None
-                response = None
-                tries = 2
-                while response is None and tries > 0:
-                    try:
-                        response = client.converse(
-                            modelId=args.model_id,
-                            messages=conversation,
-                            system=[{"text": SYSTEM_PROMPT}],
-                            inferenceConfig={
-                                "maxTokens": 512,
-                                "temperature": args.temperature,
-                                "topP": 0.9
-                            },
-                        )
-                        pending_content: str = response['output']['message']['content'][0]['text']
-                        logger.debug(f"Response before processing guardrails: {pending_content}")
-                        for guardrail in output_guardrails:
-                            guardrail.evaluate(pending_content)
-                        content = pending_content
-                    except botocore.exceptions.ClientError as e:
-                        response = None
-                        logger.info(f"caught exception {e.__class__.__name__}, retrying...")
-                        time.sleep(1)
-                        tries -= 1
-                    except NotTranslatedLlmResponseException:
-                        response = None
-                        logger.warning("Received a non-English response. Attempting to redirect...")
-                        # Continue the conversation and add a request to LLM to fix the previous response
-                        conversation.extend([
-                            {
-                                "role": "assistant",
-                                "content": [{"text": pending_content}],
-                            },
-                            {
-                                "role": "user",
-                                "content": [{"text": "The previous response was not translated into English. "
-                                                     "Please only give English topics."}],
-                            }
-                        ])
-                        time.sleep(1)
-                        tries -= 1
-                    except InvalidLlmResponseException as e:
-                        response = None
-                        logger.error(f"Received an invalid LLM response: {e}, retrying...")
-                        time.sleep(1)
-                        tries -= 1
-                if content is None:
-                    logger.error(f"Failed to get output for video {data['id']} after retries, skipping.")
-                    continue
-
-                topics = [line.strip() for line in content.splitlines() if len(line.strip()) > 0]
-                ts = datetime.fromtimestamp(data['timestamp'])
-                for topic in topics:
-                    processed_topic = post_process_topic(topic)
-                    channel_name = data.get('channel', data.get('uploader', '<missing>'))
-                    view_count = data.get('view_count', -1)
-                    like_count = data.get('like_count', -1)
-                    duration = data.get('duration', -1)
-                    writer.writerow([
-                        data['id'], data['channel_id'], channel_name,
-                        ts.year, ts.month, ts.day, data['timestamp'],
-                        view_count, like_count, duration,
-                        processed_topic])
+    backend = create_backend(args, client_factory, client_args)
+    # A backend that answers requests in batches needs enough of them in flight to fill a batch
+    concurrency = max(args.concurrency, backend.batch_size)
+    rate_limiter = AdaptiveRateLimiter()
+    usage = _TokenUsage()
+    cache = _open_cache(args)
+    dedup = DedupIndex(args.data_dir, args.dedup_threshold) if args.dedup else None
+    # Packed replies come from a different prompt, so they're cached apart from the single video ones
+    cache_prompt = PACKED_SYSTEM_PROMPT if args.pack > 1 else SYSTEM_PROMPT
+    shared = 0
+    with contextlib.ExitStack() as stack:
+        index = stack.enter_context(open_shard_index(args)) if videos is None else None
+        for shard, lease in iter_shards(args, 'topics'):
+            shard_videos = videos if index is None else progress(index.videos(), "Videos", total=len(index))
+            with (open_row_writer(args.data_dir, 'topics', TOPIC_COLUMNS, args.format, shard) as writer,
+                  ThreadPoolExecutor(max_workers=concurrency) as executor):
+                seen = writer.completed_videos()
+                pending = _PendingVideos(writer, cache, dedup)
+
+                def request(job: Tuple[str, str]) -> List[Tuple[str, str | None]]:
+                    key, desc = job
+                    usage.record_videos('individual', 1)
+                    return [(key, _request_topics(backend, args, desc, output_guardrails, rate_limiter, usage))]
+
+                def request_packed(jobs: List[Tuple[str, str]]) -> List[Tuple[str, str | None]]:
+                    return _request_packed_topics(backend, args, jobs, output_guardrails, rate_limiter, usage)
+
+                def iter_requests() -> Iterator[Tuple[str, str]]:
+                    held_videos = while_held(in_shard(shard_videos, shard), lease)
+                    for video, desc in _iter_pending_videos(held_videos, seen, input_guardrails):
+                        key = response_cache_key(backend.model_id, cache_prompt, args.temperature, desc)
+                        if pending.add(key, video, desc):
+                            yield key, desc
+
+                requests = iter_requests()
+                if args.batch:
+                    # Each shard keeps its jobs apart, so only the host holding the shard resumes them
+                    work_dir = args.data_dir / BATCH_SUBDIR
+                    if shard is not None:
+                        work_dir = work_dir / str(shard)
+                    job = BedrockBatchJob(client_factory("bedrock", **client_args),
+                                          client_factory("s3", **client_args),
+                                          args.model_id, args.batch_role_arn, args.batch_s3_uri,
+                                          work_dir, args.batch_poll_interval)
+                    requests = _request_batch(job, args.temperature, requests, output_guardrails, pending)
+                if args.pack > 1:
+                    _request_sync(executor, concurrency, _chunked(requests, args.pack), request_packed, pending)
+                else:
+                    _request_sync(executor, concurrency, requests, request, pending)
+                shared += pending.shared
+
+    backend.close()
+    usage.summarize()
+    input_guardrails.summarize()
+    output_guardrails.summarize()
+    if cache is not None:
+        cache.close()
+        metrics.count('llm.cache_hits', cache.hits)
+        metrics.count('llm.cache_misses', cache.misses)
+        logger.info(f"Response cache: {cache.hits} hits, {cache.misses} misses")
+    if shared:
+        logger.info(f"{shared} videos shared a response with an identical description in the same run")
+    if dedup is not None:
+        dedup.close()
+        metrics.count('dedup.topics.reused', dedup.reused)
+        logger.info(f"{dedup.reused} videos reused the topics of a near-duplicate")
@@ -1,18 +1,101 @@
-import json
+from collections import Counter, deque
+from concurrent.futures import Future, ProcessPoolExecutor
+import logging
+import sqlite3
+from typing import Iterable, Iterator, List, Tuple
 
 import rich
 
-from ..models import Args
-from ..utils import find_urls_in_text
+from ..constants import URLS_FILE
+from ..metadata_index import VideoMetadata, indexed_videos
+from ..metrics import metrics
+from ..models import UrlExtractionArgs
+from ..utils import find_urls_many, normalize_url
 
+logger = logging.getLogger(__name__)
 
-def extract_urls(args: Args):
-    urls = set()
-    for file_path in (args.data_dir / 'videos').glob('**/*.info.json'):
-        with open(file_path, 'r') as f:
-            info_json = json.load(f)
-        description = info_json['description']
-        for url in find_urls_in_text(description):
-            if url not in urls:
-                rich.print(url)
-            urls.add(url)
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scanned_videos (
+    id TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS urls (
+    url TEXT NOT NULL,
+    video_id TEXT NOT NULL,
+    channel_id TEXT,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (url, video_id)
+);
+"""
+
+# Number of descriptions scanned per worker task and per database transaction
+BATCH_SIZE = 500
+
+VideoUrls = Tuple[str, str | None, Counter]
+
+
+def _scan_batch(batch: List[Tuple[str, str | None, str]]) -> List[VideoUrls]:
+    results = []
+    found = find_urls_many(description for _, _, description in batch)
+    for (video_id, channel_id, _), urls in zip(batch, found):
+        results.append((video_id, channel_id, Counter(normalize_url(url) for url in urls)))
+    return results
+
+
+def _iter_pending_batches(args: UrlExtractionArgs, conn: sqlite3.Connection,
+                          videos: Iterable[VideoMetadata] | None) -> Iterator[List[Tuple[str, str, str]]]:
+    batch = []
+    with indexed_videos(args.data_dir, videos) as videos:
+        for video in videos:
+            if conn.execute("SELECT 1 FROM scanned_videos WHERE id = ?", (video.id,)).fetchone():
+                continue
+            batch.append((video.id, video.channel_id, video.description or ''))
+            if len(batch) >= BATCH_SIZE:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def _scan(args: UrlExtractionArgs, conn: sqlite3.Connection,
+          videos: Iterable[VideoMetadata] | None) -> Iterator[List[VideoUrls]]:
+    batches = _iter_pending_batches(args, conn, videos)
+    if args.workers == 1:
+        yield from map(_scan_batch, batches)
+        return
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        in_flight: deque[Future] = deque()
+        for batch in batches:
+            in_flight.append(executor.submit(_scan_batch, batch))
+            if len(in_flight) >= args.workers * 2:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
+
+
+def extract_urls(args: UrlExtractionArgs, videos: Iterable[VideoMetadata] | None = None):
+    """Scan the descriptions of videos, or of every video in the metadata index if videos isn't given"""
+    urls_file = args.data_dir / URLS_FILE
+    logger.info(f"Writing URLs to {urls_file}")
+    conn = sqlite3.connect(urls_file)
+    conn.executescript(SCHEMA)
+    scanned = 0
+    new_urls = 0
+    try:
+        for results in _scan(args, conn, videos):
+            # Each batch is committed along with its scanned markers so an interrupted run resumes where it stopped
+            with metrics.timer('urls.write_batch'), conn:
+                for video_id, channel_id, urls in results:
+                    for url, count in urls.items():
+                        if not conn.execute("SELECT 1 FROM urls WHERE url = ? LIMIT 1", (url,)).fetchone():
+                            rich.print(url)
+                            new_urls += 1
+                            metrics.count('urls.new')
+                        conn.execute("INSERT OR REPLACE INTO urls (url, video_id, channel_id, count) "
+                                     "VALUES (?, ?, ?, ?)", (url, video_id, channel_id, count))
+                    conn.execute("INSERT OR IGNORE INTO scanned_videos (id) VALUES (?)", (video_id,))
+            scanned += len(results)
+            metrics.count('urls.videos', len(results))
+            logger.debug(f"Scanned {scanned} videos")
+    finally:
+        conn.close()
+    logger.info(f"Scanned {scanned} new videos, found {new_urls} new URLs")
@@ -2,3 +2,22 @@ import pathlib
 
 DEFAULT_DATA_DIR = pathlib.Path(__file__).parent.parent / 'data'
 VIDEO_SUBDIR = "videos"
+METADATA_INDEX_FILE = "metadata_index.sqlite"
+URLS_FILE = "urls.sqlite"
+# Containers yt-dlp may save 'bestaudio' in when audio isn't converted to mp3 while downloading
+NATIVE_AUDIO_EXTENSIONS = ('.webm', '.m4a', '.opus', '.ogg', '.mp4', '.aac', '.mka')
+LLM_CACHE_FILE = "llm_cache.sqlite"
+BATCH_SUBDIR = "batch_jobs"
+PROGRESS_FILE = "progress.sqlite"
+# Stages the run command passes each downloaded video through
+PIPELINE_STAGES = ['stats', 'urls', 'topics', 'transcripts']
+# Each shard of a sharded run writes its output part, journal and lease here
+SHARD_SUBDIR = "shards"
+# Segment stores that hold transcripts and metadata instead of one file per video
+STORE_SUBDIR = "store"
+# MinHash index used to find near-duplicate videos
+DEDUP_INDEX_FILE = "dedup.sqlite"
+# Packed topic requests leave room for this many output tokens per video, up to the limit of one reply
+MAX_TOKENS_PER_PACKED_VIDEO = 64
+MAX_PACKED_TOKENS = 4096
+MAX_PACK = MAX_PACKED_TOKENS // MAX_TOKENS_PER_PACKED_VIDEO
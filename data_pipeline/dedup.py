@@ -0,0 +1,212 @@
+import hashlib
+import logging
+import pathlib
+import shutil
+import sqlite3
+import subprocess
+import zlib
+from typing import Iterable, List, NamedTuple
+
+try:
+    import numpy as np
+    supports_dedup = True
+except ImportError:
+    supports_dedup = False
+
+from .constants import DEDUP_INDEX_FILE
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS signatures (
+    kind TEXT NOT NULL,
+    video_id TEXT NOT NULL,
+    signature BLOB NOT NULL,
+    duration REAL,
+    PRIMARY KEY (kind, video_id)
+) WITHOUT ROWID;
+-- the bucket is a hash of the kind, the band and the band's rows of the signature
+CREATE TABLE IF NOT EXISTS buckets (
+    bucket INTEGER NOT NULL,
+    video_id TEXT NOT NULL,
+    PRIMARY KEY (bucket, video_id)
+) WITHOUT ROWID;
+-- videos each stage has produced a result for, with the result itself if it's small enough to keep here
+CREATE TABLE IF NOT EXISTS results (
+    stage TEXT NOT NULL,
+    video_id TEXT NOT NULL,
+    content TEXT,
+    PRIMARY KEY (stage, video_id)
+) WITHOUT ROWID;
+-- videos that were given the result of a near-duplicate instead of being processed
+CREATE TABLE IF NOT EXISTS reuses (
+    stage TEXT NOT NULL,
+    video_id TEXT NOT NULL,
+    source_id TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    similarity REAL NOT NULL,
+    PRIMARY KEY (stage, video_id)
+);
+"""
+
+NUM_PERMUTATIONS = 128
+# 16 bands of 8 rows make videos about 0.7 similar or more likely to share a bucket
+BANDS = 16
+ROWS_PER_BAND = NUM_PERMUTATIONS // BANDS
+SHINGLE_WORDS = 3
+MERSENNE_PRIME = (1 << 61) - 1
+# Bucket shared by too many videos, e.g. every empty description, only this many are compared
+MAX_BUCKET_CANDIDATES = 100
+# Only this much of each audio file is fingerprinted
+FINGERPRINT_SECONDS = 120
+
+supports_audio_fingerprint = shutil.which('fpcalc') is not None
+
+
+def text_shingles(text: str) -> List[str]:
+    """Overlapping runs of SHINGLE_WORDS words, so reordered or lightly edited descriptions still overlap"""
+    words = text.lower().split()
+    if len(words) <= SHINGLE_WORDS:
+        return [' '.join(words)] if words else []
+    return [' '.join(words[i:i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1)]
+
+
+def audio_shingles(audio_file: pathlib.Path) -> List[int]:
+    """
+    Chromaprint fingerprint of the start of the audio, one 32-bit value per ~0.12s, from fpcalc.
+    Re-uploads and re-encodes of the same audio share most of these values, unrelated audio almost none.
+    """
+    result = subprocess.run(['fpcalc', '-raw', '-length', str(FINGERPRINT_SECONDS), str(audio_file)],
+                            capture_output=True, text=True)
+    for line in result.stdout.splitlines():
+        if line.startswith('FINGERPRINT='):
+            return [int(value) for value in line.removeprefix('FINGERPRINT=').split(',') if value]
+    logger.debug(f"Could not fingerprint {audio_file}: {result.stderr.strip()}")
+    return []
+
+
+class MinHasher:
+    """MinHash signatures, whose share of equal values estimates the Jaccard similarity of two sets"""
+
+    def __init__(self, seed: int = 1):
+        # Fixed seed, the signatures in the index have to stay comparable across runs and hosts
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, 1 << 32, NUM_PERMUTATIONS, dtype=np.uint64)
+        self.b = rng.integers(0, 1 << 32, NUM_PERMUTATIONS, dtype=np.uint64)
+
+    def signature(self, shingles: Iterable[str | int]) -> 'np.ndarray | None':
+        hashes = np.fromiter({zlib.crc32(s.encode('utf-8')) if isinstance(s, str) else s & 0xFFFFFFFF
+                              for s in shingles}, dtype=np.uint64)
+        if len(hashes) == 0:
+            return None
+        # 32-bit hashes times 32-bit coefficients can't overflow 64 bits
+        return ((np.outer(hashes, self.a) + self.b) % MERSENNE_PRIME).min(axis=0).astype(np.uint32)
+
+
+def _buckets(kind: str, signature: 'np.ndarray') -> List[int]:
+    buckets = []
+    for band in range(BANDS):
+        rows = signature[band * ROWS_PER_BAND:(band + 1) * ROWS_PER_BAND].tobytes()
+        digest = hashlib.blake2b(rows, digest_size=8, key=kind.encode('utf-8'), salt=band.to_bytes(2, 'big')).digest()
+        buckets.append(int.from_bytes(digest, 'big', signed=True))
+    return buckets
+
+
+class Match(NamedTuple):
+    source_id: str
+    similarity: float
+    content: str | None
+
+
+class DedupIndex:
+    """
+    Locality sensitive hashing index of MinHash signatures, by kind ('text' for descriptions, 'audio'
+    for audio fingerprints), along with the results stages have produced. A video whose signature is
+    close enough to one that already has a result can reuse that result instead of being processed.
+    Signatures are added as videos come through, so the index grows incrementally.
+    Not thread safe, use it from a single thread.
+    """
+
+    def __init__(self, data_dir: pathlib.Path, threshold: float):
+        self.threshold = threshold
+        self.conn = sqlite3.connect(data_dir / DEDUP_INDEX_FILE, timeout=60)
+        # Hosts of a sharded run share the index over filesystems where WAL doesn't work, like the progress journals
+        self.conn.execute("PRAGMA journal_mode = DELETE")
+        self.conn.executescript(SCHEMA)
+        self.reused = 0
+
+    def __enter__(self) -> 'DedupIndex':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    # Every write is committed right away, the topics and transcripts stages of the run command share the
+    # index and would otherwise block each other for as long as one keeps a transaction open
+    def add(self, kind: str, video_id: str, signature: 'np.ndarray', duration: float | None = None):
+        with self.conn:
+            inserted = self.conn.execute(
+                "INSERT OR IGNORE INTO signatures (kind, video_id, signature, duration) VALUES (?, ?, ?, ?)",
+                (kind, video_id, signature.tobytes(), duration)).rowcount
+            if inserted:
+                self.conn.executemany("INSERT OR IGNORE INTO buckets (bucket, video_id) VALUES (?, ?)",
+                                      ((bucket, video_id) for bucket in _buckets(kind, signature)))
+
+    def signature(self, kind: str, video_id: str) -> 'np.ndarray | None':
+        row = self.conn.execute("SELECT signature FROM signatures WHERE kind = ? AND video_id = ?",
+                                (kind, video_id)).fetchone()
+        return np.frombuffer(row[0], dtype=np.uint32) if row is not None else None
+
+    def candidates(self, kind: str, signature: 'np.ndarray', exclude: str | None = None) -> Iterable[str]:
+        found = set()
+        for bucket in _buckets(kind, signature):
+            rows = self.conn.execute("SELECT video_id FROM buckets WHERE bucket = ? LIMIT ?",
+                                     (bucket, MAX_BUCKET_CANDIDATES))
+            found.update(video_id for (video_id,) in rows)
+        found.discard(exclude)
+        return found
+
+    def find_result(self, stage: str, kind: str, signature: 'np.ndarray', video_id: str,
+                    duration: float | None = None, max_duration_difference: float | None = None) -> Match | None:
+        """
+        The most similar video above the threshold that stage already has a result for. If
+        max_duration_difference is given, only videos whose duration is that close (as a fraction) count.
+        """
+        best: Match | None = None
+        for candidate in self.candidates(kind, signature, exclude=video_id):
+            row = self.conn.execute(
+                "SELECT s.signature, s.duration, r.content FROM signatures s "
+                "JOIN results r ON r.stage = ? AND r.video_id = s.video_id WHERE s.kind = ? AND s.video_id = ?",
+                (stage, kind, candidate)).fetchone()
+            if row is None:
+                continue
+            candidate_signature, candidate_duration, content = row
+            if max_duration_difference is not None:
+                if not duration or not candidate_duration:
+                    continue
+                if abs(duration - candidate_duration) > max_duration_difference * max(duration, candidate_duration):
+                    continue
+            similarity = float(np.mean(np.frombuffer(candidate_signature, dtype=np.uint32) == signature))
+            if similarity >= self.threshold and (best is None or similarity > best.similarity):
+                best = Match(candidate, similarity, content)
+        return best
+
+    def has_result(self, stage: str, video_id: str) -> bool:
+        return self.conn.execute("SELECT 1 FROM results WHERE stage = ? AND video_id = ?",
+                                 (stage, video_id)).fetchone() is not None
+
+    def record_result(self, stage: str, video_id: str, content: str | None = None):
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO results (stage, video_id, content) VALUES (?, ?, ?)",
+                              (stage, video_id, content))
+
+    def record_reuse(self, stage: str, video_id: str, kind: str, match: Match):
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO reuses (stage, video_id, source_id, kind, similarity) "
+                              "VALUES (?, ?, ?, ?, ?)", (stage, video_id, match.source_id, kind, match.similarity))
+        self.reused += 1
+        logger.info(f"Reusing the {stage} of {match.source_id} for {video_id}, "
+                    f"{match.similarity:.0%} similar by {kind}")
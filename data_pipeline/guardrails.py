@@ -1,6 +1,13 @@
 from abc import ABC, abstractmethod
+import logging
+import threading
+import time
+from typing import Dict, Iterable, List
 
-import langdetect
+from .language import detect_language, init_language_detector
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
 
 
 class InvalidLlmInputException(Exception):
@@ -15,28 +22,51 @@ class NotTranslatedLlmResponseException(InvalidLlmResponseException):
     pass
 
 
-class InputGuardrail(ABC):
+class Guardrail(ABC):
+    # Relative cost of evaluating the guardrail, cheaper guardrails are checked first
+    cost: int = 1
+    # Checked ahead of cheaper guardrails because its rejection is retried differently, not just repeated
+    redirects: bool = False
+
+    @abstractmethod
+    def evaluate(self, text: str):
+        raise NotImplementedError()
+
+
+class InputGuardrail(Guardrail, ABC):
     @abstractmethod
     def evaluate(self, llm_input: str):
         raise NotImplementedError()
 
 
-class OutputGuardrail(ABC):
+class OutputGuardrail(Guardrail, ABC):
     @abstractmethod
     def evaluate(self, llm_response: str):
         raise NotImplementedError()
 
 
 class SufficientTextGuardrail(InputGuardrail):
+    cost = 0
+
     def evaluate(self, llm_input: str):
         if len(llm_input) < 20:
             raise InvalidLlmInputException(f"Not enough text to process, received only {len(llm_input)} characters")
 
 
 class TranslatedGuardrail(OutputGuardrail):
+    cost = 10
+    # A non-English reply is asked to be translated, which must win over a generic format rejection
+    redirects = True
+
+    def __init__(self):
+        init_language_detector()
+
     def evaluate(self, llm_response: str):
-        lang = langdetect.detect(llm_response)
-        if not llm_response.isascii() and lang != 'en':
+        # Pure ASCII responses always pass, so only detect the language when it can change the outcome
+        if llm_response.isascii():
+            return
+        lang = detect_language(llm_response)
+        if lang != 'en':
             raise NotTranslatedLlmResponseException(
                 f"Language of LLM response contains non-ascii letters, detected language: {lang}")
 
@@ -56,3 +86,49 @@ class OutputFormatCheckerGuardrail(OutputGuardrail):
         lines = [line for line in llm_response.splitlines() if len(line.strip()) > 0]
         if len(lines) < self.expected_lines:
             raise InvalidLlmResponseException(f"Response contained {len(lines)} lines, expected {self.expected_lines}")
+
+
+class GuardrailStats:
+    def __init__(self):
+        self.evaluations = 0
+        self.rejections = 0
+        self.seconds = 0.0
+
+
+class GuardrailChain:
+    """
+    Evaluates guardrails cheapest first, stopping at the first one that rejects the text.
+    Guardrails that redirect the retry go before all others, whatever their cost.
+    Keeps per-guardrail timing and rejection counts, and is safe to share between threads.
+    """
+
+    def __init__(self, guardrails: Iterable[Guardrail]):
+        self.guardrails: List[Guardrail] = sorted(guardrails, key=lambda guardrail: (not guardrail.redirects, guardrail.cost))
+        self.stats: Dict[str, GuardrailStats] = {
+            guardrail.__class__.__name__: GuardrailStats() for guardrail in self.guardrails
+        }
+        self._lock = threading.Lock()
+
+    def evaluate(self, text: str):
+        for guardrail in self.guardrails:
+            start = time.perf_counter()
+            rejected = False
+            try:
+                guardrail.evaluate(text)
+            except (InvalidLlmInputException, InvalidLlmResponseException):
+                rejected = True
+                raise
+            finally:
+                elapsed = time.perf_counter() - start
+                metrics.observe(f"guardrails.{guardrail.__class__.__name__}", elapsed)
+                with self._lock:
+                    stats = self.stats[guardrail.__class__.__name__]
+                    stats.evaluations += 1
+                    stats.rejections += rejected
+                    stats.seconds += elapsed
+
+    def summarize(self):
+        for name, stats in self.stats.items():
+            if stats.evaluations:
+                logger.info(f"{name}: rejected {stats.rejections} of {stats.evaluations}, "
+                            f"{stats.seconds / stats.evaluations * 1000:.3f}ms per evaluation")
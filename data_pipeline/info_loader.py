@@ -0,0 +1,141 @@
+import json
+import logging
+import os
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from collections import deque
+from typing import Any, Iterable, Iterator, List, Tuple
+
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+try:
+    import msgspec
+
+    class _InfoFields(msgspec.Struct):
+        """Decoding into a struct lets msgspec skip formats, thumbnails, etc. without building them"""
+        id: Any
+        channel_id: Any = None
+        channel: Any = None
+        uploader: Any = None
+        timestamp: Any = None
+        view_count: Any = None
+        like_count: Any = None
+        duration: Any = None
+        fulltitle: Any = None
+        title: Any = None
+        description: Any = None
+
+    _decoder = msgspec.json.Decoder(_InfoFields)
+
+    def _decode(raw: bytes) -> dict:
+        return msgspec.structs.asdict(_decoder.decode(raw))
+
+    JSON_PARSER = "msgspec"
+except ImportError:
+    try:
+        import orjson
+
+        _decode = orjson.loads
+        JSON_PARSER = "orjson"
+    except ImportError:
+        _decode = json.loads
+        JSON_PARSER = "json"
+
+# Number of files handed to a worker process at a time
+CHUNK_SIZE = 64
+
+
+def project_info(data: dict) -> dict:
+    """Keep only the fields of a yt-dlp info dict that the commands use"""
+    return {
+        "id": data['id'],
+        "channel_id": data.get('channel_id'),
+        "channel": data.get('channel') or data.get('uploader'),
+        "timestamp": data.get('timestamp'),
+        "view_count": data.get('view_count'),
+        "like_count": data.get('like_count'),
+        "duration": data.get('duration'),
+        "title": data.get('fulltitle') or data.get('title'),
+        "description": data.get('description'),
+    }
+
+
+def parse_info(raw: bytes) -> dict:
+    return project_info(_decode(raw))
+
+
+def load_info_file(path: str) -> dict:
+    with open(path, 'rb') as f:
+        return parse_info(f.read())
+
+
+# (path, fields, error, seconds reading, seconds parsing)
+_Record = Tuple[str, dict | None, str | None, float, float]
+
+
+def _load_chunk(paths: List[str]) -> List[_Record]:
+    # Errors and timings are passed back so they're logged and recorded by the parent process
+    records = []
+    for path in paths:
+        start = time.perf_counter()
+        read = start
+        try:
+            with open(path, 'rb') as f:
+                raw = f.read()
+            read = time.perf_counter()
+            fields = project_info(_decode(raw))
+            records.append((path, fields, None, read - start, time.perf_counter() - read))
+        except (OSError, ValueError, KeyError) as e:
+            records.append((path, None, f"{e.__class__.__name__}: {e}", read - start, 0.0))
+    return records
+
+
+def _unpack(records: List[_Record]) -> Iterator[Tuple[str, dict | None]]:
+    for path, fields, error, read_seconds, parse_seconds in records:
+        metrics.observe('info.read', read_seconds)
+        if error is not None:
+            logger.warning(f"Could not read {path}: {error}")
+        else:
+            metrics.observe('info.parse', parse_seconds)
+        yield path, fields
+
+
+def _chunks(paths: Iterable[str], size: int) -> Iterator[List[str]]:
+    chunk = []
+    for path in paths:
+        chunk.append(path)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def load_info_files(paths: Iterable[str], workers: int | None = None) -> Iterator[Tuple[str, dict | None]]:
+    """
+    Read and parse .info.json files across a pool of processes, yielding (path, fields)
+    in the same order as paths. Only a few chunks are in flight at once so memory stays
+    bounded no matter how many paths there are. fields is None if the file could not be read.
+    """
+    workers = workers or os.cpu_count() or 1
+    chunks = _chunks(paths, CHUNK_SIZE)
+    first = next(chunks, None)
+    if first is None:
+        return
+    if workers == 1 or len(first) < CHUNK_SIZE:
+        # Not worth starting a pool for a handful of files
+        yield from _unpack(_load_chunk(first))
+        for chunk in chunks:
+            yield from _unpack(_load_chunk(chunk))
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        in_flight: deque[Future] = deque([executor.submit(_load_chunk, first)])
+        for chunk in chunks:
+            in_flight.append(executor.submit(_load_chunk, chunk))
+            if len(in_flight) >= workers * 2:
+                yield from _unpack(in_flight.popleft().result())
+        while in_flight:
+            yield from _unpack(in_flight.popleft().result())
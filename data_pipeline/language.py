@@ -0,0 +1,46 @@
+from collections import OrderedDict
+import hashlib
+import threading
+
+import langdetect
+import langdetect.detector_factory
+
+# Detected languages are remembered by a hash of the text, bounded to this many entries
+MAX_CACHED_TEXTS = 100_000
+
+_lock = threading.Lock()
+_initialized = False
+_cache: OrderedDict[bytes, str] = OrderedDict()
+
+
+def init_language_detector():
+    """
+    Load langdetect's language profiles once, up front. langdetect loads them lazily on first
+    use, which is slow and not thread safe, and its results are random unless seeded.
+    """
+    global _initialized
+    with _lock:
+        if _initialized:
+            return
+        langdetect.DetectorFactory.seed = 0
+        langdetect.detector_factory.init_factory()
+        _initialized = True
+
+
+def detect_language(text: str) -> str:
+    """
+    Deterministic, memoized langdetect.detect. Raises langdetect.LangDetectException if
+    the text has nothing to detect a language from.
+    """
+    init_language_detector()
+    key = hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+    with _lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+    lang = langdetect.detect(text)
+    with _lock:
+        _cache[key] = lang
+        if len(_cache) > MAX_CACHED_TEXTS:
+            _cache.popitem(last=False)
+    return lang
@@ -0,0 +1,192 @@
+from abc import ABC, abstractmethod
+from collections import Counter
+from concurrent.futures import Future
+import importlib.util
+import json
+import logging
+import queue
+import re
+import threading
+import time
+from typing import Callable, Dict, List, Tuple
+
+from .models import TopicGenerationArgs
+
+logger = logging.getLogger(__name__)
+
+# transformers pulls in torch, which takes seconds to import, so only check whether it's installed
+supports_local_llm = (importlib.util.find_spec('transformers') is not None
+                      and importlib.util.find_spec('torch') is not None)
+
+# How long the local backend waits for more requests to fill a batch before running what it has
+MAX_BATCH_WAIT_SECONDS = 0.05
+
+
+def _response(text: str, input_tokens: int, output_tokens: int) -> dict:
+    """The parts of a Converse API response the topic generator reads"""
+    return {
+        "output": {"message": {"role": "assistant", "content": [{"text": text}]}},
+        "usage": {"inputTokens": input_tokens, "outputTokens": output_tokens},
+    }
+
+
+class LlmBackend(ABC):
+    """
+    Answers requests in the shape of the Bedrock Converse API (modelId, messages, system,
+    inferenceConfig) with a response in the same shape, so the retries and guardrails built
+    around converse work the same whatever model is behind it.
+    """
+    # Identifies the model in the response cache, so responses from different models aren't mixed up
+    model_id: str
+    # Number of requests the backend can answer at once, the topic generator keeps at least this many in flight
+    batch_size: int = 1
+
+    @abstractmethod
+    def converse(self, **request) -> dict:
+        pass
+
+    def close(self):
+        pass
+
+
+class BedrockBackend(LlmBackend):
+    def __init__(self, client, model_id: str):
+        self.client = client
+        self.model_id = model_id
+
+    def converse(self, **request) -> dict:
+        return self.client.converse(**request)
+
+
+class StubBackend(LlmBackend):
+    """
+    Deterministic offline backend for tests: the topics of a text are its three most common
+    longer words. Packed requests, a JSON object of texts, get a JSON object of topics back.
+    """
+    model_id = "stub"
+
+    @staticmethod
+    def _topics(text: str) -> List[str]:
+        words = Counter(word.lower() for word in re.findall(r"[^\W\d_]{4,}", text))
+        topics = [word.capitalize() for word, _ in words.most_common(3)]
+        return topics + ["General"] * (3 - len(topics))
+
+    def converse(self, **request) -> dict:
+        text = request["messages"][-1]["content"][0]["text"]
+        try:
+            texts = json.loads(text)
+        except json.JSONDecodeError:
+            texts = None
+        if isinstance(texts, dict):
+            reply = json.dumps({text_id: self._topics(str(body)) for text_id, body in texts.items()})
+        else:
+            reply = '\n'.join(self._topics(text))
+        return _response(reply, len(text) // 4, len(reply) // 4)
+
+
+class TransformersBackend(LlmBackend):
+    """
+    Runs a local instruction-tuned model with Hugging Face transformers, on the CPU unless a GPU is
+    available. Requests from the topic generator's worker threads are queued and answered in batches
+    of up to batch_size conversations per generate() call, which is far faster than one at a time.
+    """
+
+    def __init__(self, model_name: str, batch_size: int):
+        import torch
+        import transformers
+
+        self.model_id = f"local:{model_name}"
+        self.batch_size = batch_size
+        self._torch = torch
+        self.tokenizer = transformers.AutoTokenizer.from_pretrained(model_name, padding_side='left')
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.model = transformers.AutoModelForCausalLM.from_pretrained(model_name, torch_dtype='auto')
+        self.model.eval()
+        self._queue: queue.Queue[Tuple[dict, Future] | None] = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name="local-llm", daemon=True)
+        self._worker.start()
+        logger.info(f"Loaded {model_name} on {self.model.device}")
+
+    def converse(self, **request) -> dict:
+        future: Future = Future()
+        self._queue.put((request, future))
+        return future.result()
+
+    def close(self):
+        self._queue.put(None)
+        self._worker.join()
+
+    def _next_batch(self) -> List[Tuple[dict, Future]] | None:
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + MAX_BATCH_WAIT_SECONDS
+        while len(batch) < self.batch_size:
+            try:
+                item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if item is None:
+                # Put the shutdown marker back so it's seen once this batch is answered
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while (batch := self._next_batch()) is not None:
+            # Only requests with the same settings can share a generate() call
+            groups: Dict[str, List[Tuple[dict, Future]]] = {}
+            for request, future in batch:
+                groups.setdefault(json.dumps(request.get("inferenceConfig", {}), sort_keys=True), []).append(
+                    (request, future))
+            for items in groups.values():
+                try:
+                    responses = self._generate([request for request, _ in items])
+                except Exception as e:
+                    for _, future in items:
+                        future.set_exception(e)
+                    continue
+                for (_, future), response in zip(items, responses):
+                    future.set_result(response)
+
+    def _prompt(self, request: dict) -> str:
+        messages = [{"role": "system", "content": '\n'.join(part["text"] for part in request.get("system", []))}]
+        for message in request["messages"]:
+            messages.append({"role": message["role"],
+                             "content": '\n'.join(part["text"] for part in message["content"])})
+        return self.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+
+    def _generate(self, requests: List[dict]) -> List[dict]:
+        config = requests[0].get("inferenceConfig", {})
+        temperature = config.get("temperature", 0.0)
+        inputs = self.tokenizer([self._prompt(request) for request in requests],
+                                return_tensors='pt', padding=True).to(self.model.device)
+        with self._torch.inference_mode():
+            output = self.model.generate(
+                **inputs,
+                max_new_tokens=config.get("maxTokens", 512),
+                do_sample=temperature > 0,
+                temperature=temperature if temperature > 0 else None,
+                top_p=config.get("topP") if temperature > 0 else None,
+                pad_token_id=self.tokenizer.pad_token_id,
+            )
+        input_length = inputs["input_ids"].shape[1]
+        responses = []
+        for i, tokens in enumerate(output[:, input_length:]):
+            text = self.tokenizer.decode(tokens, skip_special_tokens=True).strip()
+            input_tokens = int(inputs["attention_mask"][i].sum())
+            output_tokens = int((tokens != self.tokenizer.pad_token_id).sum())
+            responses.append(_response(text, input_tokens, output_tokens))
+        logger.debug(f"Generated {len(requests)} responses in one batch")
+        return responses
+
+
+def create_backend(args: TopicGenerationArgs, client_factory: Callable, client_args: dict) -> LlmBackend:
+    if args.backend == 'stub':
+        return StubBackend()
+    if args.backend == 'local':
+        return TransformersBackend(args.local_model, args.local_batch_size)
+    return BedrockBackend(client_factory("bedrock-runtime", **client_args), args.model_id)
@@ -0,0 +1,89 @@
+import hashlib
+import json
+import logging
+import pathlib
+import sqlite3
+import time
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    content TEXT NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used);
+"""
+
+# Eviction is checked after this many new entries rather than on every write
+EVICTION_INTERVAL = 1000
+
+
+def response_cache_key(model_id: str, system_prompt: str, temperature: float, text: str) -> str:
+    """Hash of everything that affects the model's response"""
+    payload = json.dumps([model_id, system_prompt, temperature, text], ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """
+    Persistent cache of LLM responses. Once it holds more than max_entries responses the
+    least recently used ones are evicted. A read_only cache answers from the responses already
+    in it without changing the file. Not thread safe, use it from a single thread.
+    """
+
+    def __init__(self, path: pathlib.Path, max_entries: int, read_only: bool = False):
+        self.max_entries = max_entries
+        self.read_only = read_only
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        if read_only:
+            self.conn = sqlite3.connect(f"{path.absolute().as_uri()}?mode=ro", uri=True)
+        else:
+            self.conn = sqlite3.connect(path)
+            self.conn.executescript(SCHEMA)
+
+    def __enter__(self) -> 'ResponseCache':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.evict()
+        self.conn.close()
+
+    def get(self, key: str) -> str | None:
+        row = self.conn.execute("SELECT content FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if self.read_only:
+            return row[0]
+        with self.conn:
+            self.conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+        return row[0]
+
+    def put(self, key: str, content: str):
+        if self.read_only:
+            return
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO responses (key, content, last_used) VALUES (?, ?, ?)",
+                              (key, content, time.time()))
+        self._writes += 1
+        if self._writes % EVICTION_INTERVAL == 0:
+            self.evict()
+
+    def evict(self):
+        if self.read_only:
+            return
+        count = self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        if count <= self.max_entries:
+            return
+        with self.conn:
+            self.conn.execute("DELETE FROM responses WHERE key IN "
+                              "(SELECT key FROM responses ORDER BY last_used LIMIT ?)", (count - self.max_entries,))
+        logger.debug(f"Evicted {count - self.max_entries} responses from the cache")
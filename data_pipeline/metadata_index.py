@@ -0,0 +1,235 @@
+import contextlib
+import dataclasses
+import logging
+import os
+import pathlib
+import sqlite3
+from typing import TYPE_CHECKING, Dict, Iterable, Iterator, List, Set, Tuple
+
+from .constants import METADATA_INDEX_FILE, VIDEO_SUBDIR
+from .info_loader import load_info_files, parse_info
+from .metrics import metrics, progress
+from .segment_store import open_store, store_dir, supports_segment_store
+from .sharding import held_lease, is_sharded
+
+if TYPE_CHECKING:
+    from .models import ShardedArgs
+
+logger = logging.getLogger(__name__)
+
+# Bump whenever the columns change, the index is rebuilt from scratch on the next refresh.
+SCHEMA_VERSION = 1
+# Changes are committed in batches of this many files, so a refresh never holds the write lock for long
+COMMIT_FILES = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS videos (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    id TEXT NOT NULL,
+    channel_id TEXT,
+    channel TEXT,
+    timestamp INTEGER,
+    view_count INTEGER,
+    like_count INTEGER,
+    -- no declared type so integer durations aren't turned into floats
+    duration,
+    title TEXT,
+    description TEXT
+);
+CREATE INDEX IF NOT EXISTS videos_id ON videos (id);
+"""
+
+COLUMNS = ("path", "mtime_ns", "size", "id", "channel_id", "channel", "timestamp",
+           "view_count", "like_count", "duration", "title", "description")
+
+
+@dataclasses.dataclass
+class VideoMetadata:
+    """The handful of fields the commands need from a yt-dlp .info.json file"""
+    id: str
+    path: pathlib.Path
+    channel_id: str | None
+    channel: str | None
+    timestamp: int | None
+    view_count: int | None
+    like_count: int | None
+    duration: float | None
+    title: str | None
+    description: str | None
+
+
+class MetadataIndex:
+    """
+    SQLite index of every .info.json file under the videos directory. Files are only
+    re-parsed when their mtime or size changes, so refreshing an unchanged archive
+    costs a stat call per file. Videos whose .info.json file was moved into the info segment
+    store are kept, and added back from the store if the index is rebuilt.
+    A read_only index can only be queried, and has to exist.
+    """
+
+    def __init__(self, data_dir: pathlib.Path, read_only: bool = False):
+        self.data_dir = data_dir
+        self.video_dir = data_dir / VIDEO_SUBDIR
+        path = data_dir / METADATA_INDEX_FILE
+        if read_only:
+            self.conn = sqlite3.connect(f"{path.absolute().as_uri()}?mode=ro", uri=True, timeout=60)
+            return
+        self.conn = sqlite3.connect(path, timeout=60)
+        # Sharded runs share the index between hosts, over filesystems where WAL doesn't work
+        self.conn.execute("PRAGMA journal_mode = DELETE")
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        if version != SCHEMA_VERSION:
+            self.conn.execute("DROP TABLE IF EXISTS videos")
+            self.conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self.conn.executescript(SCHEMA)
+
+    def __enter__(self) -> 'MetadataIndex':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def _scan(self) -> Iterator[os.DirEntry]:
+        if not self.video_dir.exists():
+            return
+        stack = [str(self.video_dir)]
+        while stack:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        stack.append(entry.path)
+                    elif entry.name.endswith('.info.json'):
+                        yield entry
+
+    def refresh(self, workers: int | None = None) -> None:
+        known = {path: (mtime_ns, size) for path, mtime_ns, size
+                 in self.conn.execute("SELECT path, mtime_ns, size FROM videos")}
+        # Everything either in the index or on disk, the videos in the store but neither have to be restored
+        listed = set(known)
+        changed = {}
+        for entry in self._scan():
+            path = os.path.relpath(entry.path, self.video_dir)
+            listed.add(path)
+            stat = entry.stat()
+            if known.pop(path, None) != (stat.st_mtime_ns, stat.st_size):
+                changed[entry.path] = (path, stat.st_mtime_ns, stat.st_size)
+
+        indexed = 0
+        loaded = load_info_files(changed, workers=workers)
+        for full_path, fields in progress(loaded, "Indexing metadata", total=len(changed), unit="file"):
+            if fields is None:
+                continue
+            self._upsert(*changed[full_path], fields)
+            indexed += 1
+            if indexed % COMMIT_FILES == 0:
+                self.conn.commit()
+                logger.info(f"Indexed {indexed}/{len(changed)} new or changed files")
+        with self.conn:
+            removed, restored = self._sync_with_store(known, listed)
+            self.conn.executemany("DELETE FROM videos WHERE path = ?", ((path,) for path in removed))
+        metrics.count('metadata.indexed', indexed + restored)
+        logger.info(f"Metadata index refreshed: {indexed} new or changed, {restored} restored from the info store, "
+                    f"{len(removed)} removed")
+
+    def _sync_with_store(self, missing: Iterable[str], listed: Set[str]) -> Tuple[List[str], int]:
+        """
+        The missing files that are really gone rather than moved into the info segment store, and
+        the number of videos added back from the store because they were neither on disk nor in the
+        index, e.g. after the index was deleted.
+        """
+        if not store_dir(self.data_dir, 'info').exists():
+            return list(missing), 0
+        if not supports_segment_store:
+            logger.warning("zstandard not found, videos whose .info.json file is in the store are left out")
+            return list(missing), 0
+        restored = 0
+        with open_store(self.data_dir, 'info', read_only=True) as store:
+            removed = [path for path in missing if not store.has_path(path)]
+            for key, path in store.paths():
+                if path not in listed:
+                    # Stored records have no mtime, so a file later written back to the path is parsed again
+                    data = store.get(key)
+                    self._upsert(path, 0, len(data), parse_info(data))
+                    restored += 1
+        return removed, restored
+
+    def _upsert(self, path: str, mtime_ns: int, size: int, fields: dict):
+        row = {"path": path, "mtime_ns": mtime_ns, "size": size, **fields}
+        self.conn.execute(
+            f"INSERT OR REPLACE INTO videos ({', '.join(COLUMNS)}) "
+            f"VALUES ({', '.join(':' + c for c in COLUMNS)})", row)
+
+    def add(self, path: pathlib.Path) -> VideoMetadata | None:
+        """Index a single .info.json file, e.g. one that was just downloaded, without scanning the directory"""
+        stat = path.stat()
+        [(_, fields)] = load_info_files([str(path)], workers=1)
+        if fields is None:
+            return None
+        with self.conn:
+            self._upsert(os.path.relpath(path, self.video_dir), stat.st_mtime_ns, stat.st_size, fields)
+        return self.get_by_path(path)
+
+    def _to_video(self, row: tuple) -> VideoMetadata:
+        values = dict(zip(COLUMNS, row))
+        values['path'] = self.video_dir / values['path']
+        del values['mtime_ns'], values['size']
+        return VideoMetadata(**values)
+
+    def __len__(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM videos").fetchone()[0]
+
+    def videos(self) -> Iterator[VideoMetadata]:
+        for row in self.conn.execute(f"SELECT {', '.join(COLUMNS)} FROM videos ORDER BY path"):
+            yield self._to_video(row)
+
+    def ids_by_path(self) -> Dict[str, str]:
+        """The ID of every indexed video, by the path of its .info.json file relative to the videos directory"""
+        return dict(self.conn.execute("SELECT path, id FROM videos"))
+
+    def get(self, video_id: str) -> VideoMetadata | None:
+        row = self.conn.execute(f"SELECT {', '.join(COLUMNS)} FROM videos WHERE id = ?", (video_id,)).fetchone()
+        return self._to_video(row) if row is not None else None
+
+    def get_by_path(self, path: pathlib.Path) -> VideoMetadata | None:
+        rel_path = os.path.relpath(path, self.video_dir)
+        row = self.conn.execute(f"SELECT {', '.join(COLUMNS)} FROM videos WHERE path = ?", (rel_path,)).fetchone()
+        return self._to_video(row) if row is not None else None
+
+
+def open_metadata_index(data_dir: pathlib.Path) -> MetadataIndex:
+    """Open the metadata index for data_dir and bring it up to date with the files on disk"""
+    index = MetadataIndex(data_dir)
+    index.refresh()
+    return index
+
+
+def open_shard_index(args: 'ShardedArgs') -> MetadataIndex:
+    """
+    Open the refreshed metadata index that every shard of the run reads its videos from, refreshing it once
+    for all of them. The processes of a sharded run, on any number of hosts, take turns refreshing it and
+    then only read it.
+    """
+    if not is_sharded(args):
+        return open_metadata_index(args.data_dir)
+    with held_lease(args.data_dir, 'metadata_index', args.lease):
+        open_metadata_index(args.data_dir).close()
+    return MetadataIndex(args.data_dir, read_only=True)
+
+
+@contextlib.contextmanager
+def indexed_videos(data_dir: pathlib.Path,
+                   videos: Iterable[VideoMetadata] | None = None) -> Iterator[Iterable[VideoMetadata]]:
+    """
+    Use the given videos if there are any, otherwise every video in the refreshed metadata index
+    with a progress bar
+    """
+    if videos is not None:
+        yield videos
+        return
+    with open_metadata_index(data_dir) as index:
+        yield progress(index.videos(), "Videos", total=len(index))
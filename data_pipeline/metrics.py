@@ -0,0 +1,145 @@
+import contextlib
+import json
+import logging
+import pathlib
+import random
+import threading
+import time
+from typing import Dict, Iterable, Iterator, List, TypeVar
+
+from tqdm import tqdm
+
+logger = logging.getLogger(__name__)
+
+# Latency percentiles are computed from a uniform sample of at most this many observations per stage
+RESERVOIR_SIZE = 10_000
+PERCENTILES = (50, 95, 99)
+
+T = TypeVar('T')
+
+
+class _Timer:
+    def __init__(self, seed: int):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples: List[float] = []
+        self._random = random.Random(seed)
+
+    def observe(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        if len(self.samples) < RESERVOIR_SIZE:
+            self.samples.append(seconds)
+        else:
+            # Reservoir sampling keeps every observation equally likely to be in the sample
+            i = self._random.randrange(self.count)
+            if i < RESERVOIR_SIZE:
+                self.samples[i] = seconds
+
+    def summary(self, elapsed: float) -> dict:
+        samples = sorted(self.samples)
+        summary = {
+            "count": self.count,
+            "total_seconds": self.total,
+            "mean_seconds": self.total / self.count,
+            "max_seconds": self.max,
+            "per_second": self.count / elapsed if elapsed else 0.0,
+        }
+        for p in PERCENTILES:
+            summary[f"p{p}_seconds"] = samples[min(len(samples) - 1, len(samples) * p // 100)]
+        return summary
+
+
+class Metrics:
+    """
+    Per-stage timings and event counters for a single command run. Safe to use from several
+    threads. Work done in worker processes has to be timed there and reported back with observe().
+    """
+
+    def __init__(self):
+        self.command: str | None = None
+        self._start = time.perf_counter()
+        self._timers: Dict[str, _Timer] = {}
+        self._counters: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def start(self, command: str):
+        self.command = command
+        self._start = time.perf_counter()
+
+    def observe(self, stage: str, seconds: float):
+        with self._lock:
+            timer = self._timers.get(stage)
+            if timer is None:
+                timer = self._timers[stage] = _Timer(len(self._timers))
+            timer.observe(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, stage: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def count(self, name: str, n: int = 1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def summary(self) -> dict:
+        elapsed = time.perf_counter() - self._start
+        with self._lock:
+            return {
+                "command": self.command,
+                "elapsed_seconds": elapsed,
+                "stages": {stage: timer.summary(elapsed) for stage, timer in sorted(self._timers.items())},
+                "counters": dict(sorted(self._counters.items())),
+            }
+
+    def write(self, path: pathlib.Path):
+        """Write the summary as a Prometheus textfile if path ends in .prom, JSON otherwise"""
+        summary = self.summary()
+        if path.suffix == '.prom':
+            content = _prometheus(summary)
+        else:
+            content = json.dumps(summary, indent=2) + '\n'
+        # Written atomically so a textfile collector never reads a partial file
+        tmp_path = path.with_name(path.name + '.tmp')
+        tmp_path.write_text(content)
+        tmp_path.replace(path)
+        logger.info(f"Wrote metrics to {path}")
+
+
+def _prometheus(summary: dict) -> str:
+    command = summary["command"]
+    lines = [
+        "# HELP data_pipeline_run_seconds Wall time of the command run",
+        "# TYPE data_pipeline_run_seconds gauge",
+        f'data_pipeline_run_seconds{{command="{command}"}} {summary["elapsed_seconds"]}',
+        "# HELP data_pipeline_stage_seconds Time spent in each stage of the command",
+        "# TYPE data_pipeline_stage_seconds summary",
+    ]
+    for stage, stats in summary["stages"].items():
+        labels = f'command="{command}",stage="{stage}"'
+        for p in PERCENTILES:
+            lines.append(f'data_pipeline_stage_seconds{{{labels},quantile="{p / 100}"}} {stats[f"p{p}_seconds"]}')
+        lines.append(f'data_pipeline_stage_seconds_sum{{{labels}}} {stats["total_seconds"]}')
+        lines.append(f'data_pipeline_stage_seconds_count{{{labels}}} {stats["count"]}')
+    lines += [
+        "# HELP data_pipeline_events_total Events counted while the command ran",
+        "# TYPE data_pipeline_events_total counter",
+    ]
+    for name, value in summary["counters"].items():
+        lines.append(f'data_pipeline_events_total{{command="{command}",event="{name}"}} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def progress(iterable: Iterable[T], desc: str, total: int | None = None, unit: str = "video") -> Iterable[T]:
+    """A progress bar with rate and ETA, only shown when stderr is a terminal"""
+    return tqdm(iterable, desc=desc, total=total, unit=unit, disable=None, dynamic_ncols=True)
+
+
+# Shared by every module, like a logger
+metrics = Metrics()
@@ -1,20 +1,89 @@
 import pathlib
-from typing import List
+from typing import TYPE_CHECKING, List
+
+if TYPE_CHECKING:
+    from .sharding import Shard
 
 
 class Args:
     command: str
     data_dir: pathlib.Path
     debug: bool
+    metrics_file: pathlib.Path | None
+    profile: pathlib.Path | None
 
 
 class DownloaderArgs(Args):
     cookies: pathlib.Path
     wait: int
+    limit_rate: str | None
+    parallel_channels: int
+    stage: str
+    defer_audio_extraction: bool
     channel_urls: List[str]
 
 
-class TopicGenerationArgs(Args):
+class ShardedArgs(Args):
+    shard: 'Shard | None'
+    claim_shards: int | None
+    lease: int
+
+
+class DedupArgs(Args):
+    dedup: bool
+    dedup_threshold: float
+
+
+class StatsExportArgs(Args):
+    format: str
+
+
+class TopicGenerationArgs(ShardedArgs, DedupArgs):
+    format: str
+    backend: str
+    local_model: str
+    local_batch_size: int
     region: str
     model_id: str
     temperature: float
+    concurrency: int
+    cache_size: int
+    pack: int
+    batch: bool
+    batch_s3_uri: str | None
+    batch_role_arn: str | None
+    batch_poll_interval: int
+
+
+class UrlExtractionArgs(Args):
+    workers: int
+
+
+class TranscriptionArgs(ShardedArgs, DedupArgs):
+    model: str
+    workers: int
+    threads: int | None
+    streaming: bool
+    window: int
+    store: bool
+    audio_fingerprint: bool
+
+
+class AudioExtractionArgs(Args):
+    workers: int
+    quality: int
+    delete_source: bool
+
+
+class MergeArgs(Args):
+    format: str
+
+
+class StoreArgs(Args):
+    collections: List[str]
+    delete: bool
+
+
+class PipelineArgs(DownloaderArgs, StatsExportArgs, TopicGenerationArgs, UrlExtractionArgs, TranscriptionArgs):
+    queue_size: int
+    skip: List[str]
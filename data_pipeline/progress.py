@@ -0,0 +1,99 @@
+import logging
+import pathlib
+import sqlite3
+from typing import Iterable, Set
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS videos (
+    output TEXT NOT NULL,
+    video_id TEXT NOT NULL,
+    PRIMARY KEY (output, video_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS offsets (
+    output TEXT PRIMARY KEY,
+    offset INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS parts (
+    output TEXT NOT NULL,
+    part TEXT NOT NULL,
+    PRIMARY KEY (output, part)
+);
+"""
+
+
+class ProgressJournal:
+    """
+    Records which videos have been completely written to each output, along with the point the
+    output was committed up to (a byte offset for CSV files, the written part files for Parquet).
+    Videos and their commit point are saved in a single transaction, so anything written to an
+    output after its last commit belongs to videos that will be processed again.
+    A read_only journal can only be queried, and has to exist.
+    """
+
+    def __init__(self, path: pathlib.Path, read_only: bool = False):
+        if read_only:
+            self.conn = sqlite3.connect(f"{path.absolute().as_uri()}?mode=ro", uri=True, timeout=60)
+            return
+        self.conn = sqlite3.connect(path, timeout=60)
+        # Hosts of a sharded run open the journals over a shared filesystem, where WAL doesn't work.
+        # The journal mode is stored in the file, so journals created in WAL mode are switched back.
+        self.conn.execute("PRAGMA journal_mode = DELETE")
+        self.conn.executescript(SCHEMA)
+
+    def __enter__(self) -> 'ProgressJournal':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def is_empty(self, output: str) -> bool:
+        return (self.conn.execute("SELECT 1 FROM offsets WHERE output = ?", (output,)).fetchone() is None
+                and self.conn.execute("SELECT 1 FROM parts WHERE output = ? LIMIT 1", (output,)).fetchone() is None)
+
+    def reset(self, output: str):
+        with self.conn:
+            for table in ('videos', 'offsets', 'parts'):
+                self.conn.execute(f"DELETE FROM {table} WHERE output = ?", (output,))
+
+    def contains(self, output: str, video_id: str) -> bool:
+        return self.conn.execute("SELECT 1 FROM videos WHERE output = ? AND video_id = ?",
+                                 (output, video_id)).fetchone() is not None
+
+    def offset(self, output: str) -> int | None:
+        row = self.conn.execute("SELECT offset FROM offsets WHERE output = ?", (output,)).fetchone()
+        return row[0] if row else None
+
+    def parts(self, output: str) -> Set[str]:
+        return {row[0] for row in self.conn.execute("SELECT part FROM parts WHERE output = ?", (output,))}
+
+    def commit(self, output: str, video_ids: Iterable[str], offset: int | None = None,
+               parts: Iterable[str] = ()):
+        with self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO videos (output, video_id) VALUES (?, ?)",
+                                  ((output, video_id) for video_id in video_ids))
+            if offset is not None:
+                self.conn.execute("INSERT OR REPLACE INTO offsets (output, offset) VALUES (?, ?)", (output, offset))
+            self.conn.executemany("INSERT OR IGNORE INTO parts (output, part) VALUES (?, ?)",
+                                  ((output, part) for part in parts))
+
+
+class CompletedVideos:
+    """
+    Container of the videos committed to an output, looked up in the journal instead of loaded up front.
+    A shard's output also counts the videos already merged into the main output as completed.
+    """
+
+    def __init__(self, journal: ProgressJournal, output: str, merged: 'CompletedVideos | None' = None):
+        self.journal = journal
+        self.output = output
+        self.merged = merged
+
+    def __contains__(self, video_id: str) -> bool:
+        if self.journal.contains(self.output, video_id):
+            return True
+        return self.merged is not None and video_id in self.merged
@@ -0,0 +1,170 @@
+import logging
+import mmap
+import pathlib
+import sqlite3
+import time
+from typing import Dict, Iterator, List, Tuple
+
+try:
+    import zstandard
+    supports_segment_store = True
+except ImportError:
+    supports_segment_store = False
+
+from .constants import STORE_SUBDIR
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS segments (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS records (
+    key TEXT PRIMARY KEY,
+    -- where the record lived in the per-file layout, relative to the videos directory
+    path TEXT NOT NULL,
+    segment INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS records_path ON records (path);
+"""
+
+INDEX_FILE = "index.sqlite"
+# A writer moves on to a new segment file once its current one reaches this size
+SEGMENT_BYTES = 256 * 1024 * 1024
+# Number of records appended before they are added to the index in one transaction
+COMMIT_RECORDS = 100
+COMPRESSION_LEVEL = 3
+
+# What each collection holds, by the suffix its records had in the per-file layout
+COLLECTIONS = {
+    'info': '.info.json',
+    'transcripts': '.transcript.txt',
+}
+
+
+def store_dir(data_dir: pathlib.Path, collection: str) -> pathlib.Path:
+    return data_dir / STORE_SUBDIR / collection
+
+
+class SegmentStore:
+    """
+    Append-only store of many small documents (transcripts, .info.json files) in a few large segment
+    files. Every record is compressed as its own zstd frame, so it can be read on its own through
+    an mmap of its segment, and reading a whole collection is one sequential pass over each segment.
+
+    The index of where each record lives is a SQLite database next to the segments. Records are only
+    added to it after they are written, so an interrupted write leaves some unreferenced bytes at the
+    end of a segment rather than a broken record. Each writer appends to segments of its own, which
+    lets several processes write into the same store. Writing a key again points it at the new copy,
+    the old one stays in its segment. A read_only store can only be read from, and has to exist.
+    """
+
+    def __init__(self, path: pathlib.Path, read_only: bool = False):
+        self.path = path
+        if read_only:
+            self.conn = sqlite3.connect(f"{(path / INDEX_FILE).absolute().as_uri()}?mode=ro", uri=True, timeout=60)
+        else:
+            path.mkdir(parents=True, exist_ok=True)
+            self.conn = sqlite3.connect(path / INDEX_FILE, timeout=60)
+            # Hosts of a sharded run share the store over filesystems where WAL doesn't work
+            self.conn.execute("PRAGMA journal_mode = DELETE")
+            self.conn.executescript(SCHEMA)
+        self._maps: Dict[int, mmap.mmap] = {}
+        self._decompressor = zstandard.ZstdDecompressor()
+        self._compressor: zstandard.ZstdCompressor | None = None
+        self._segment: int | None = None
+        self._file = None
+        self._pending: List[Tuple[str, str, int, int, int, int]] = []
+
+    def __enter__(self) -> 'SegmentStore':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+        for segment_map in self._maps.values():
+            segment_map.close()
+        self.conn.close()
+
+    def _segment_file(self, segment: int) -> pathlib.Path:
+        return self.path / f"segment-{segment:06d}.zst"
+
+    def _new_segment(self):
+        if self._file is not None:
+            self.flush()
+            self._file.close()
+        with self.conn:
+            self._segment = self.conn.execute("INSERT INTO segments (created) VALUES (?)",
+                                              (time.time(),)).lastrowid
+        self._file = open(self._segment_file(self._segment), 'ab')
+
+    def put(self, key: str, path: str, data: bytes):
+        if self._compressor is None:
+            self._compressor = zstandard.ZstdCompressor(level=COMPRESSION_LEVEL)
+        if self._file is None or self._file.tell() >= SEGMENT_BYTES:
+            self._new_segment()
+        frame = self._compressor.compress(data)
+        offset = self._file.tell()
+        self._file.write(frame)
+        self._pending.append((key, path, self._segment, offset, len(frame), len(data)))
+        if len(self._pending) >= COMMIT_RECORDS:
+            self.flush()
+
+    def flush(self):
+        """Make every record put so far readable, from this process and others"""
+        if not self._pending:
+            return
+        self._file.flush()
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO records (key, path, segment, offset, length, size) VALUES (?, ?, ?, ?, ?, ?)",
+                self._pending)
+        self._pending = []
+
+    def _read(self, segment: int, offset: int, length: int, size: int) -> bytes:
+        segment_map = self._maps.get(segment)
+        if segment_map is None or offset + length > len(segment_map):
+            # Segments still being written grow after they're mapped, map them again to see the new records
+            if segment_map is not None:
+                segment_map.close()
+            with open(self._segment_file(segment), 'rb') as f:
+                segment_map = self._maps[segment] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with memoryview(segment_map) as view:
+            return self._decompressor.decompress(view[offset:offset + length], max_output_size=size)
+
+    def __contains__(self, key: str) -> bool:
+        return self.conn.execute("SELECT 1 FROM records WHERE key = ?", (key,)).fetchone() is not None
+
+    def __len__(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM records").fetchone()[0]
+
+    def has_path(self, path: str) -> bool:
+        return self.conn.execute("SELECT 1 FROM records WHERE path = ?", (path,)).fetchone() is not None
+
+    def paths(self) -> Iterator[Tuple[str, str]]:
+        """Every (key, path) in the store, without reading the records"""
+        yield from self.conn.execute("SELECT key, path FROM records")
+
+    def get(self, key: str) -> bytes | None:
+        row = self.conn.execute("SELECT segment, offset, length, size FROM records WHERE key = ?",
+                                (key,)).fetchone()
+        return self._read(*row) if row is not None else None
+
+    def items(self) -> Iterator[Tuple[str, str, bytes]]:
+        """Every (key, path, data) in the store, in the order they were written so segments are read sequentially"""
+        rows = self.conn.execute("SELECT key, path, segment, offset, length, size FROM records "
+                                 "ORDER BY segment, offset")
+        for key, path, *location in rows:
+            yield key, path, self._read(*location)
+
+
+def open_store(data_dir: pathlib.Path, collection: str, read_only: bool = False) -> SegmentStore:
+    return SegmentStore(store_dir(data_dir, collection), read_only)
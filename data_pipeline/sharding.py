@@ -0,0 +1,193 @@
+import contextlib
+import hashlib
+import logging
+import os
+import pathlib
+import threading
+import time
+from typing import TYPE_CHECKING, Iterable, Iterator, NamedTuple, Tuple, TypeVar
+
+from .constants import SHARD_SUBDIR
+
+if TYPE_CHECKING:
+    from .metadata_index import VideoMetadata
+    from .models import ShardedArgs
+
+logger = logging.getLogger(__name__)
+
+LEASE_SUBDIR = "leases"
+# How often a process waiting for a held lease checks whether it was released
+LEASE_POLL_SECONDS = 1
+
+T = TypeVar('T')
+
+
+class Shard(NamedTuple):
+    index: int
+    count: int
+
+    def __str__(self) -> str:
+        width = len(str(self.count - 1))
+        return f"shard-{self.index:0{width}d}-of-{self.count}"
+
+    def contains(self, video_id: str) -> bool:
+        # Python's hash() is salted per process, so hash the ID with something stable across hosts
+        digest = hashlib.blake2b(video_id.encode('utf-8'), digest_size=8).digest()
+        return int.from_bytes(digest, 'big') % self.count == self.index
+
+
+def shard_dir(data_dir: pathlib.Path) -> pathlib.Path:
+    return data_dir / SHARD_SUBDIR
+
+
+class ShardLease:
+    """
+    Exclusive claim on a shard, held as a lock file on the shared data directory. The lease expires
+    if its file isn't touched for lease_seconds, so a shard held by a crashed host is picked up again.
+    A background thread keeps renewing it while the shard is being processed.
+    Relies on O_EXCL creation and atomic renames, which NFS v3+ and most cluster filesystems provide.
+    """
+
+    def __init__(self, path: pathlib.Path, owner: str, lease_seconds: int):
+        self.path = path
+        self.owner = owner
+        self.lease_seconds = lease_seconds
+        self.lost = False
+        self._stop = threading.Event()
+        self._heartbeat: threading.Thread | None = None
+
+    def _create(self) -> bool:
+        try:
+            fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as f:
+            f.write(self.owner)
+        return True
+
+    def _expired(self, path: pathlib.Path) -> bool:
+        return time.time() - path.stat().st_mtime > self.lease_seconds
+
+    def acquire(self) -> bool:
+        if not self._create():
+            try:
+                if not self._expired(self.path):
+                    return False
+                # Only one host can rename the expired lease away, the others get FileNotFoundError
+                stale = self.path.with_name(f"{self.path.name}.stale-{self.owner}")
+                os.rename(self.path, stale)
+            except FileNotFoundError:
+                return False
+            if not self._expired(stale):
+                # Another host replaced the lease between our check and the rename, give it back
+                try:
+                    os.link(stale, self.path)
+                except FileExistsError:
+                    pass
+                stale.unlink()
+                return False
+            logger.warning(f"Taking over expired lease {self.path.name} from {stale.read_text()}")
+            stale.unlink()
+            if not self._create():
+                return False
+        self._heartbeat = threading.Thread(target=self._renew, name=f"lease-{self.path.name}", daemon=True)
+        self._heartbeat.start()
+        return True
+
+    def _renew(self):
+        while not self._stop.wait(self.lease_seconds / 3):
+            try:
+                if self.path.read_text() != self.owner:
+                    raise FileNotFoundError
+                os.utime(self.path)
+            except FileNotFoundError:
+                self.lost = True
+                logger.error(f"Lost lease {self.path.name}, another host may be processing the same shard")
+                return
+
+    def release(self):
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+        if not self.lost:
+            self.path.unlink(missing_ok=True)
+
+
+def _lease_dir(data_dir: pathlib.Path) -> pathlib.Path:
+    lease_dir = shard_dir(data_dir) / LEASE_SUBDIR
+    lease_dir.mkdir(parents=True, exist_ok=True)
+    return lease_dir
+
+
+def _owner() -> str:
+    return f"{os.uname().nodename}:{os.getpid()}"
+
+
+@contextlib.contextmanager
+def held_lease(data_dir: pathlib.Path, name: str, lease_seconds: int) -> Iterator[ShardLease]:
+    """Wait until no other process holds the named lease and hold it for the duration of the block"""
+    lease = ShardLease(_lease_dir(data_dir) / f"{name}.lease", _owner(), lease_seconds)
+    if not lease.acquire():
+        logger.info(f"Waiting for another process to release {lease.path.name}")
+        while not lease.acquire():
+            time.sleep(LEASE_POLL_SECONDS)
+    try:
+        yield lease
+    finally:
+        lease.release()
+
+
+def claim_shards(data_dir: pathlib.Path, name: str, count: int,
+                 lease_seconds: int) -> Iterator[Tuple[Shard, ShardLease]]:
+    """
+    Yield each of count shards that no other process holds along with its lease, claiming it until
+    the caller asks for the next one. Any number of processes on any number of hosts sharing data_dir
+    can run this at once and each shard is processed by one of them at a time.
+    """
+    lease_dir = _lease_dir(data_dir)
+    owner = _owner()
+    skipped = 0
+    for index in range(count):
+        shard = Shard(index, count)
+        lease = ShardLease(lease_dir / f"{name}.{shard}.lease", owner, lease_seconds)
+        if not lease.acquire():
+            logger.debug(f"{shard} is claimed by another process")
+            skipped += 1
+            continue
+        logger.info(f"Claimed {name} {shard}")
+        try:
+            yield shard, lease
+        finally:
+            lease.release()
+    if skipped:
+        logger.info(f"{skipped} of {count} shards were claimed by other processes")
+
+
+def in_shard(videos: Iterable['VideoMetadata'], shard: Shard | None) -> Iterable['VideoMetadata']:
+    if shard is None:
+        return videos
+    return (video for video in videos if shard.contains(video.id))
+
+
+def while_held(items: Iterable[T], lease: ShardLease | None) -> Iterator[T]:
+    """Stop yielding items once the lease is lost, the shard now belongs to another process"""
+    for item in items:
+        if lease is not None and lease.lost:
+            logger.warning(f"Stopping work on {lease.path.name}, its lease was lost")
+            return
+        yield item
+
+
+def is_sharded(args: 'ShardedArgs') -> bool:
+    return args.shard is not None or args.claim_shards is not None
+
+
+def iter_shards(args: 'ShardedArgs', name: str) -> Iterable[Tuple[Shard | None, ShardLease | None]]:
+    """
+    The shards this process works through, each with its lease if it was claimed: the ones it manages
+    to claim with --claim-shards, the one given with --shard, or None to process every video into the
+    main output.
+    """
+    if args.claim_shards:
+        return claim_shards(args.data_dir, name, args.claim_shards, args.lease)
+    return [(args.shard, None)]
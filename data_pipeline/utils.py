@@ -1,43 +1,24 @@
+import pathlib
 import re
+from typing import Dict, Iterable, Iterator, List
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 
+from .constants import NATIVE_AUDIO_EXTENSIONS
 
-def pre_process_description(description: str) -> str:
-    try:
-        idx = description.index('Im Arabic')
-        if idx >= 0:
-            description = description[:idx]
-    except ValueError:
-        pass
-    subs = [
-        (r"Website: http[\w:/%.-]+", ""),
-        (r"Facebook: http[\w:/%.-]+", ""),
-        (r"Tiwtter: http[\w:/%.-]+", ""),
-        (r"Twitter: http[\w:/%.-]+", ""),
-        (r"Instagram: http[\w:/%.-]+", ""),
-        (r"Youtube: http[\w:/%.-]+", ""),
-        (r"-{2,}", ""),
-        (r"\s+", " "),
-        (r"\n", " "),
-    ]
-    for sub in subs:
-        description = re.sub(sub[0], sub[1], description)
-    return description.strip()
-
-
-def post_process_topic(topic: str) -> str:
-    subs = [
-        (r"-", ""),
-        (r"^\d+\.", ""),
-        (r"\*", ""),
-    ]
-    for sub in subs:
-        topic = re.sub(sub[0], sub[1], topic)
-    return topic.strip().lower()
+# Social links and runs of dashes are removed in a single pass. A link's character class includes '-',
+# so dashes touching a link are consumed with it just like the old link-then-dash substitutions did.
+# Every alternative starts with a literal so the regex engine can skip ahead to candidate characters.
+_DESCRIPTION_REMOVALS = re.compile(
+    r"(?:Website|Facebook|Tiwtter|Twitter|Instagram|Youtube): http[\w:/%.-]+"
+    r"|--+"
+)
 
+# Dashes are removed before looking for a leading number so "-1. topic" still loses its number
+_TOPIC_REMOVALS = re.compile(r"^\d+\.|\*")
 
 # https://stackoverflow.com/questions/6038061/regular-expression-to-find-urls-within-a-string
-def find_urls_in_text(text: str) -> list[str]:
-    return re.findall(r"""(?:
+# The leading lookahead doesn't change what matches, it lets the engine skip positions that can't start a URL.
+_URL = re.compile(r"""(?=[hfw])(?:
         (?:https?|ftp|file)://|www\.|ftp\.
     )
     (?:
@@ -45,5 +26,83 @@ def find_urls_in_text(text: str) -> list[str]:
     )*
     (?:
         \([-A-Z0-9+&@#/%=~_|$?!:,.]*\)|[A-Z0-9+&@#/%=~_|$]
-    )""", text, flags=re.IGNORECASE | re.VERBOSE)
+    )""", flags=re.IGNORECASE | re.VERBOSE)
+
+
+def pre_process_description(description: str) -> str:
+    description = description.partition('Im Arabic')[0]
+    description = _DESCRIPTION_REMOVALS.sub("", description)
+    # Same as collapsing \s+ into a single space and stripping, str.split uses the same definition of whitespace
+    return " ".join(description.split())
+
+
+def pre_process_many(descriptions: Iterable[str]) -> List[str]:
+    return [pre_process_description(description) for description in descriptions]
+
+
+def post_process_topic(topic: str) -> str:
+    topic = _TOPIC_REMOVALS.sub("", topic.replace("-", ""))
+    return topic.strip().lower()
+
+
+def find_urls_in_text(text: str) -> list[str]:
+    return _URL.findall(text)
+
+
+def find_urls_many(texts: Iterable[str]) -> List[list[str]]:
+    findall = _URL.findall
+    return [findall(text) for text in texts]
+
+
+TRACKING_PARAMS = {'fbclid', 'gclid', 'dclid', 'igshid', 'si', 'feature', 'mc_cid', 'mc_eid', 'ref_src'}
+
+
+def normalize_url(url: str) -> str:
+    """
+    Normalize a URL found in a description so trivially different links to the same page
+    are counted together: lowercase scheme and host, no www., no tracking parameters and
+    no trailing punctuation picked up from the surrounding sentence.
+    """
+    url = url.rstrip('.,;:!?')
+    if url.endswith(')') and url.count('(') < url.count(')'):
+        url = url[:-1]
+    if '://' not in url:
+        url = ('ftp://' if url.lower().startswith('ftp.') else 'https://') + url
+    try:
+        parts = urlsplit(url)
+    except ValueError:
+        return url
+    host = parts.netloc.lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    query = [(key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+             if not key.lower().startswith('utm_') and key.lower() not in TRACKING_PARAMS]
+    path = parts.path if parts.path != '/' else ''
+    scheme = parts.scheme.lower()
+    if scheme == 'http':
+        scheme = 'https'
+    return urlunsplit((scheme, host, path, urlencode(query), parts.fragment))
+
+
+def iter_audio_files(video_dir: pathlib.Path) -> Iterator[pathlib.Path]:
+    """
+    Yield one audio file per video: the mp3 if audio was extracted, otherwise the file in
+    whichever container yt-dlp downloaded.
+    """
+    audio_files: Dict[pathlib.Path, pathlib.Path] = {}
+    for path in video_dir.glob("**/*"):
+        if path.suffix == '.mp3':
+            audio_files[path.with_suffix('')] = path
+        elif path.suffix in NATIVE_AUDIO_EXTENSIONS:
+            audio_files.setdefault(path.with_suffix(''), path)
+    yield from audio_files.values()
+
 
+def find_audio_file(info_file: pathlib.Path) -> pathlib.Path | None:
+    """The audio file downloaded along with a video's .info.json file, preferring the mp3 like iter_audio_files"""
+    base = info_file.with_name(info_file.name.removesuffix('.info.json'))
+    for extension in ('.mp3', *NATIVE_AUDIO_EXTENSIONS):
+        path = base.with_name(base.name + extension)
+        if path.exists():
+            return path
+    return None
@@ -0,0 +1,330 @@
+import csv
+import io
+import itertools
+import logging
+import os
+import pathlib
+import time
+import uuid
+from typing import Dict, Iterator, List, Sequence, Set, Tuple
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset
+    import pyarrow.parquet as pq
+    supports_parquet = True
+except ImportError:
+    supports_parquet = False
+
+from .constants import PROGRESS_FILE
+from .progress import CompletedVideos, ProgressJournal
+from .sharding import Shard, shard_dir
+
+logger = logging.getLogger(__name__)
+
+# (column name, type) pairs. Types are only used for Parquet, "category" columns are dictionary encoded.
+Columns = Sequence[Tuple[str, str]]
+
+STATS_COLUMNS: Columns = [
+    ("id", "string"), ("channel_id", "category"), ("channel_name", "category"),
+    ("year", "int16"), ("month", "int8"), ("day", "int8"), ("timestamp", "int64"),
+    ("view_count", "int64"), ("like_count", "int64"), ("duration", "float64"),
+]
+# reused_from is the video whose topics were reused for a near-duplicate, empty for generated topics
+TOPIC_COLUMNS: Columns = [*STATS_COLUMNS, ("topic", "category"), ("reused_from", "string")]
+
+PARTITION_COLUMNS = ["channel_id", "year"]
+# Number of rows buffered before they are written out as a new set of Parquet files
+PARQUET_BATCH_ROWS = 100_000
+# Number of videos buffered before they are appended to a CSV file and committed to the journal
+CSV_COMMIT_VIDEOS = 100
+
+
+class CsvRowWriter:
+    """
+    Appends rows to a CSV file. Rows are held in memory until the video they belong to is committed,
+    and committed videos are written out in groups along with the file's new length in the journal.
+    Anything past that length on startup is left over from an interrupted write and is cut off.
+    """
+
+    def __init__(self, path: pathlib.Path, columns: Columns, journal: ProgressJournal,
+                 commit_videos: int = CSV_COMMIT_VIDEOS, merged: CompletedVideos | None = None):
+        self.path = path
+        self.output = path.name
+        self.journal = journal
+        self.merged = merged
+        self.commit_videos = commit_videos
+        self._video_rows = io.StringIO()
+        self._row_writer = csv.writer(self._video_rows)
+        self._pending_rows: List[str] = []
+        self._pending_ids: List[str] = []
+        header = [name for name, _ in columns]
+        self._recover(header)
+        self._add_columns(header)
+        self._file = open(path, 'a')
+
+    def __enter__(self) -> 'CsvRowWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _recover(self, header: List[str]):
+        if not self.path.exists():
+            self.journal.reset(self.output)
+            with open(self.path, 'w') as f:
+                csv.writer(f).writerow(header)
+            self.journal.commit(self.output, [], offset=self.path.stat().st_size)
+            return
+        size = self.path.stat().st_size
+        offset = self.journal.offset(self.output)
+        if offset is None or offset > size:
+            # Written before the journal existed, or replaced since. Read it once to catch up.
+            logger.info(f"Recording the videos already written to {self.path}")
+            self.journal.reset(self.output)
+            self.journal.commit(self.output, self._read_ids(), offset=size)
+        elif offset < size:
+            logger.warning(f"Discarding {size - offset} bytes written to {self.path} after the last commit")
+            os.truncate(self.path, offset)
+
+    def _add_columns(self, header: List[str]):
+        """Rewrite a file written before columns were added to the end of its header, with the new columns empty"""
+        with open(self.path, 'r') as f:
+            old_header = next(csv.reader(f), [])
+        if old_header == header:
+            return
+        if header[:len(old_header)] != old_header:
+            raise ValueError(f"{self.path} has the columns {old_header}, expected {header}")
+        logger.info(f"Adding the {', '.join(header[len(old_header):])} columns to {self.path}")
+        padding = [''] * (len(header) - len(old_header))
+        tmp_file = self.path.with_name(self.path.name + '.tmp')
+        with open(self.path, 'r') as source, open(tmp_file, 'w') as target:
+            reader = csv.reader(source)
+            writer = csv.writer(target)
+            next(reader)
+            writer.writerow(header)
+            for row in reader:
+                writer.writerow(row + padding)
+        os.replace(tmp_file, self.path)
+        self.journal.commit(self.output, [], offset=self.path.stat().st_size)
+
+    def _read_ids(self) -> Set[str]:
+        seen = set()
+        with open(self.path, 'r') as output_csv:
+            reader = csv.reader(output_csv)
+            next(reader, None)
+            for row in reader:
+                seen.add(row[0])
+        return seen
+
+    def completed_videos(self) -> CompletedVideos:
+        return CompletedVideos(self.journal, self.output, self.merged)
+
+    def writerow(self, row: list):
+        self._row_writer.writerow(row)
+
+    def commit(self, video_id: str):
+        """Mark every row written since the last commit as belonging to the completed video_id"""
+        self._pending_rows.append(self._video_rows.getvalue())
+        self._pending_ids.append(video_id)
+        self._video_rows.seek(0)
+        self._video_rows.truncate()
+        if len(self._pending_ids) >= self.commit_videos:
+            self.flush()
+
+    def flush(self):
+        if not self._pending_ids:
+            return
+        self._file.write(''.join(self._pending_rows))
+        self._file.flush()
+        self.journal.commit(self.output, self._pending_ids, offset=os.fstat(self._file.fileno()).st_size)
+        self._pending_rows = []
+        self._pending_ids = []
+
+    def close(self):
+        # Rows of a video that was never committed are dropped, it's processed again on the next run
+        self.flush()
+        self._file.close()
+        self.journal.close()
+        if self.merged is not None:
+            self.merged.journal.close()
+
+
+class ParquetRowWriter:
+    """
+    Writes rows into a Parquet dataset partitioned by channel_id and year. Every batch of rows
+    is written as new files in the matching partitions, so an incremental run only adds files
+    and never rewrites earlier ones. A batch only includes committed videos and its files are
+    recorded in the journal with them; files from a batch that was interrupted are removed on startup.
+    """
+
+    def __init__(self, path: pathlib.Path, columns: Columns, journal: ProgressJournal,
+                 batch_rows: int = PARQUET_BATCH_ROWS, merged: CompletedVideos | None = None):
+        types = {
+            "string": pa.string(),
+            "category": pa.dictionary(pa.int32(), pa.string()),
+            "int8": pa.int8(),
+            "int16": pa.int16(),
+            "int64": pa.int64(),
+            "float64": pa.float64(),
+        }
+        self.path = path
+        self.output = path.name
+        self.journal = journal
+        self.merged = merged
+        self.schema = pa.schema([(name, types[type_name]) for name, type_name in columns])
+        self.batch_rows = batch_rows
+        # write_to_dataset silently replaces files of the same name, so runs started within a second mustn't share one
+        self._run_id = f"{time.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        self._batches = 0
+        self._rows: List[list] = []
+        self._committed_rows = 0
+        self._pending_ids: List[str] = []
+        self._recover()
+
+    def __enter__(self) -> 'ParquetRowWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @staticmethod
+    def _part_name(file: pathlib.Path) -> str:
+        # Files are named part-<run>-<batch>-<i>.parquet, with one file per partition in the batch
+        return file.name.rsplit('-', 1)[0]
+
+    def _recover(self):
+        files = list(self.path.rglob('part-*.parquet')) if self.path.exists() else []
+        if not files:
+            self.journal.reset(self.output)
+            return
+        if self.journal.is_empty(self.output):
+            logger.info(f"Recording the videos already written to {self.path}")
+            dataset = pyarrow.dataset.dataset(self.path, format='parquet', partitioning='hive')
+            ids = set(dataset.to_table(columns=['id']).column('id').to_pylist())
+            self.journal.commit(self.output, ids, parts={self._part_name(file) for file in files})
+            return
+        committed = self.journal.parts(self.output)
+        for file in files:
+            if self._part_name(file) not in committed:
+                logger.warning(f"Removing {file}, it was written by an interrupted batch")
+                file.unlink()
+
+    def completed_videos(self) -> CompletedVideos:
+        return CompletedVideos(self.journal, self.output, self.merged)
+
+    def writerow(self, row: list):
+        self._rows.append(row)
+
+    def commit(self, video_id: str):
+        """Mark every row written since the last commit as belonging to the completed video_id"""
+        self._committed_rows = len(self._rows)
+        self._pending_ids.append(video_id)
+        if self._committed_rows >= self.batch_rows:
+            self.flush()
+
+    def flush(self):
+        if not self._pending_ids:
+            return
+        rows = self._rows[:self._committed_rows]
+        if rows:
+            columns: Dict[str, list] = {name: [] for name in self.schema.names}
+            for row in rows:
+                for name, value in zip(self.schema.names, row):
+                    columns[name].append(value)
+            table = pa.table(columns, schema=self.schema)
+            part = f"part-{self._run_id}-{self._batches}"
+            pq.write_to_dataset(table, self.path, partition_cols=PARTITION_COLUMNS,
+                                basename_template=f"{part}-{{i}}.parquet")
+            logger.debug(f"Wrote {len(rows)} rows to {self.path}")
+            self._batches += 1
+            self.journal.commit(self.output, self._pending_ids, parts=[part])
+        else:
+            self.journal.commit(self.output, self._pending_ids)
+        self._rows = self._rows[self._committed_rows:]
+        self._committed_rows = 0
+        self._pending_ids = []
+
+    def close(self):
+        self.flush()
+        self.journal.close()
+        if self.merged is not None:
+            self.merged.journal.close()
+
+
+def _output_name(name: str, output_format: str) -> str:
+    return name if output_format == 'parquet' else f"{name}.csv"
+
+
+def _part_journal_file(part: pathlib.Path) -> pathlib.Path:
+    return part.with_name(f"{part.name.removesuffix('.csv')}.progress.sqlite")
+
+
+def open_row_writer(data_dir: pathlib.Path, name: str, columns: Columns, output_format: str,
+                    shard: Shard | None = None) -> CsvRowWriter | ParquetRowWriter:
+    """
+    Open the output for name, either data_dir/name.csv or a Parquet dataset in data_dir/name/.
+    Progress is tracked in a journal shared by all outputs in data_dir.
+
+    A shard writes its own part in the shards directory, with its own journal so hosts sharing
+    data_dir never write to the same file. Videos already merged into the main output are skipped.
+    """
+    if shard is None:
+        path = data_dir / _output_name(name, output_format)
+        journal = ProgressJournal(data_dir / PROGRESS_FILE)
+        merged = None
+    else:
+        path = shard_dir(data_dir) / _output_name(f"{name}.{shard}", output_format)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        journal = ProgressJournal(_part_journal_file(path))
+        merged = CompletedVideos(ProgressJournal(data_dir / PROGRESS_FILE), _output_name(name, output_format))
+    if output_format == 'parquet':
+        return ParquetRowWriter(path, columns, journal, merged=merged)
+    return CsvRowWriter(path, columns, journal, merged=merged)
+
+
+def find_parts(data_dir: pathlib.Path, name: str, output_format: str) -> List[pathlib.Path]:
+    """Every shard's part of the output for name"""
+    parts = shard_dir(data_dir).glob(_output_name(f"{name}.shard-*", output_format))
+    if output_format == 'parquet':
+        # The parts' journals sit next to them and match the same pattern
+        return sorted(part for part in parts if part.is_dir())
+    return sorted(parts)
+
+
+def iter_committed_rows(part: pathlib.Path, columns: Columns,
+                        output_format: str) -> Iterator[Tuple[str, List[list]]]:
+    """
+    Yield (video id, rows) for every video committed to a shard's part. Anything written after the
+    part's last commit is left out, so a part can be read while its shard is still being processed.
+    """
+    journal_file = _part_journal_file(part)
+    if not journal_file.exists():
+        return
+    with ProgressJournal(journal_file, read_only=True) as journal:
+        offset = journal.offset(part.name)
+        parts = journal.parts(part.name)
+    names = [name for name, _ in columns]
+    if output_format == 'parquet':
+        files = [str(file) for file in sorted(part.rglob('part-*.parquet'))
+                 if ParquetRowWriter._part_name(file) in parts]
+        if not files:
+            return
+        dataset = pyarrow.dataset.dataset(files, format='parquet', partitioning='hive', partition_base_dir=str(part))
+        # Parts written before a column was added don't have it
+        present = [name for name in names if name in dataset.schema.names]
+        rows: Dict[str, List[list]] = {}
+        for record in dataset.to_table(columns=present).to_pylist():
+            rows.setdefault(record['id'], []).append([record.get(name) for name in names])
+        yield from rows.items()
+        return
+    if offset is None:
+        return
+    with open(part, 'rb') as f:
+        reader = csv.reader(io.StringIO(f.read(offset).decode('utf-8')))
+        header = next(reader, [])
+        # Parts written before columns were added leave them out
+        padding = [''] * (len(names) - len(header))
+        # Rows are written a whole video at a time, so a video's rows are always next to each other
+        for video_id, rows in itertools.groupby(reader, key=lambda row: row[0]):
+            yield video_id, [row + padding for row in rows]